@@ -45,6 +45,7 @@ sed -e 's$ExecStart=$ExecStart=%{_bindir}/libreeyed$' systemd/libreeye.service >
 mkdir -p %{buildroot}/etc
 cp -r conf %{buildroot}/etc/libreeye
 mkdir -p %{buildroot}/var/log/libreeye
+mkdir -p %{buildroot}/var/lib/libreeye
 
 #%%check
 
@@ -59,4 +60,5 @@ mkdir -p %{buildroot}/var/log/libreeye
 %config(noreplace) %attr(-, root, libreeye) /etc/libreeye/storage.conf
 %config(noreplace) %attr(-, root, libreeye) /etc/libreeye/cameras.d
 %config(noreplace) %attr(750, root, libreeye) /etc/libreeye/secrets
-%ghost %attr(775, root, libreeye) /var/log/libreeye
\ No newline at end of file
+%ghost %attr(775, root, libreeye) /var/log/libreeye
+%dir %attr(775, root, libreeye) /var/lib/libreeye
\ No newline at end of file
@@ -51,6 +51,10 @@ setuptools.setup(
     packages=setuptools.find_packages(where='src'),
     python_requires='>=3.7',
     install_requires=requirements,
+    extras_require={
+        # Motion detection from motion vectors
+        'vectors': ['av']
+    },
     entry_points={
         'console_scripts': [
             'libreeye=libreeye.main:main',
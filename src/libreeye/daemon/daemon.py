@@ -19,6 +19,7 @@ import errno
 import grp
 import json
 import logging
+import multiprocessing
 import os
 import pwd
 import sched
@@ -32,7 +33,9 @@ from daemon import DaemonContext
 from daemon.pidfile import PIDLockFile
 
 from libreeye.daemon import definitions, socket_actions
+from libreeye.md.engine import MotionEngine
 from libreeye.recording.camera import Camera
+from libreeye.recording.probe import ProbeCache
 from libreeye.storage.local import LocalStorage
 from libreeye.storage.youtube import YoutubeStorage
 from libreeye.utils.config import Config
@@ -121,6 +124,11 @@ class Daemon():
         self._cameras = {
             name: {'running': False} for name in self._conf.cameras()
         }
+        # Probe results shared by all cameras
+        self._probe_cache = ProbeCache(self._conf.daemon_probe_cache())
+        # Motion detection for all cameras, if batched. Created by run, as
+        # DaemonContext closes the pipes of its queue
+        self._motion_engine = None
         # Storage list
         self._storage = [
             LocalStorage(self._conf.storage().local()),
@@ -138,7 +146,7 @@ class Daemon():
         _logger.debug('_clean_storage_and_schedule called')
         threading.Thread(target=thread_body).start()
 
-    def start_camera(self, name, wait=False):
+    def start_camera(self, name, wait=False, startup=None):
         _logger.debug('start_camera called on %s', name)
         state = self._cameras[name]
         # Check if the recorder for the camera is already running
@@ -146,8 +154,9 @@ class Daemon():
             return
         # Start camera process
         conf = self._conf.cameras()[name]
-        camera = Camera(name, conf, self._storage)
-        camera.start(wait=wait)
+        camera = Camera(name, conf, self._storage, self._probe_cache,
+                        self._motion_engine)
+        camera.start(wait=wait, startup=startup)
         state['camera'] = camera
         state['running'] = True
 
@@ -183,9 +192,20 @@ class Daemon():
 
     def run(self):
         _logger.debug('run called')
-        # Start all cameras
+        # Cameras register their frame rings with the engine once probed
+        if self._conf.daemon_motion_engine() == 'batched':
+            self._motion_engine = MotionEngine(
+                self._conf, self._conf.daemon_motion_interval())
+            self._motion_engine.start()
+        # Start all cameras concurrently, limiting how many of them can be
+        # connecting at the same time, and wait until all have started
+        startup = multiprocessing.BoundedSemaphore(
+            self._conf.daemon_start_parallelism())
         for c in self._conf.cameras():
-            self.start_camera(c, wait=True)
+            self.start_camera(c, startup=startup)
+        for c in self._conf.cameras():
+            if self._cameras[c]['running']:
+                self._cameras[c]['camera'].wait_started()
         # Listen for requests through the socket
         server = _ThreadingUnixServer(
             definitions.socket_path,
@@ -208,6 +228,8 @@ class Daemon():
             server.shutdown()
         # Stop all running containers
         self._stop_all_cameras()
+        if self._motion_engine is not None:
+            self._motion_engine.stop()
         _logger.debug('daemon end')
 
     def terminate(self, *_):
@@ -1,14 +1,22 @@
 import argparse
 import ast
-import cv2
+import collections
 import ffmpeg
+import functools
+import glob
+import json
 import logging
-import numpy as np
+import multiprocessing
+import multiprocessing.connection
 import os
 import pyinotify
 import signal
 import sys
-from libreeye.algorithms import motion
+import threading
+import time
+from libreeye.md.algorithms.motion import detectors, motion_events
+from libreeye.md.iterator import FrameIterator
+from libreeye.md.snapshots import SnapshotWriter
 
 _logger = logging.getLogger(__name__)
 
@@ -42,73 +50,384 @@ class Listener:
         _logger.debug('Notifier thread finished')
 
 
-def build_iterator(path: str, scale=1.0):
+# Files analyzed by a worker process before it is replaced, so that memory
+# leaked by the decoders does not build up
+_tasks_per_worker = 64
+# Seconds between checks that the workers analyzing files are still alive
+_check_interval = 1.0
+# Connection and lock to report the files started, in the worker processes
+_started = None
+
+
+def _init_worker(started, started_lock):
+    # Runs in every worker process, which is killed with SIGTERM on timeout
+    global _started
+    _started = (started, started_lock)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _analyze(handler, path):
+    # Tells the dispatcher which process analyzes path, to kill it on timeout
+    started, lock = _started
+    with lock:
+        started.send((path, os.getpid()))
+    handler(path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+class AnalysisPool:
+    # Runs handler on the files submitted in a pool of workers processes.
+    # They are started by a fork server, never forked from a process running
+    # threads, and replaced after a number of files or when they die. Files
+    # wait in a backlog, where repeated notifications for a file already
+    # waiting or running are ignored, and submit blocks while it holds
+    # max_backlog files. Only one file per worker is handed to the pool at a
+    # time, and the worker analyzing a file for longer than timeout seconds
+    # is killed. done(path, success) is called from the dispatcher thread as
+    # files finish. handler must be picklable. stop only flags the pool and
+    # wakes the dispatcher up, so that signal handlers can call it, and join
+    # waits until it has stopped the workers.
+    def __init__(self, handler, workers=None, timeout=None, max_backlog=1024,
+                 done=None):
+        self._handler = handler
+        self._done = done
+        self._workers = workers or os.cpu_count() or 1
+        self._timeout = timeout
+        self._max_backlog = max_backlog
+        self._backlog = collections.OrderedDict()
+        # Result, worker pid and deadline of the files handed to the pool
+        self._running = {}
+        # Files finished, appended to by the result thread of the pool
+        self._finished = collections.deque()
+        self._lock = threading.Lock()
+        self._space = threading.Condition(self._lock)
+        # Written to wake the dispatcher thread up, without ever blocking
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._idle = threading.Event()
+        self._idle.set()
+        self._active = False
+        self._thread = None
+        # Created before any thread is started
+        context = multiprocessing.get_context('forkserver')
+        self._started_r, started_w = context.Pipe(duplex=False)
+        self._pool = context.Pool(self._workers, _init_worker,
+                                  (started_w, context.Lock()),
+                                  _tasks_per_worker)
+
+    def submit(self, path: str):
+        with self._lock:
+            while self._active and len(self._backlog) >= self._max_backlog:
+                self._space.wait()
+            if path in self._backlog or path in self._running:
+                _logger.debug('Ignoring repeated event for %s', path)
+                return
+            self._backlog[path] = None
+            self._idle.clear()
+            self._wakeup()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, b'\0')
+        except BlockingIOError:
+            # The dispatcher has yet to read the previous ones
+            pass
+
+    def _complete(self, path, task, success, value):
+        # Runs in the result thread of the pool
+        if not success:
+            _logger.warning('Analysis of %s failed', path, exc_info=value)
+        self._finished.append((path, task, success))
+        self._wakeup()
+
+    def _finish(self, path, success):
+        with self._lock:
+            del self._running[path]
+        if self._done is not None:
+            self._done(path, success)
+
+    def _dispatch(self):
+        with self._lock:
+            while len(self._running) < self._workers and self._backlog:
+                path, _ = self._backlog.popitem(last=False)
+                self._space.notify()
+                task = [None, None, None]
+                task[0] = self._pool.apply_async(
+                    _analyze, (self._handler, path),
+                    callback=functools.partial(
+                        self._complete, path, task, True),
+                    error_callback=functools.partial(
+                        self._complete, path, task, False))
+                self._running[path] = task
+
+    def _collect(self):
+        while self._started_r.poll():
+            path, pid = self._started_r.recv()
+            task = self._running.get(path)
+            if task is not None and task[1] is None:
+                task[1] = pid
+                if self._timeout is not None:
+                    task[2] = time.monotonic() + self._timeout
+        while len(self._finished) > 0:
+            path, task, success = self._finished.popleft()
+            if self._running.get(path) is task:
+                self._finish(path, success)
+
+    def _check_workers(self):
+        # The pool replaces the workers killed or dead, but never completes
+        # the file they were analyzing
+        now = time.monotonic()
+        for path, (result, pid, deadline) in list(self._running.items()):
+            if pid is None or result.ready():
+                continue
+            if deadline is not None and now >= deadline:
+                _logger.warning('Analysis of %s timed out', path)
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            elif _alive(pid):
+                continue
+            else:
+                _logger.warning('Worker analyzing %s died', path)
+            self._finish(path, False)
+
+    def _loop(self):
+        while True:
+            try:
+                while os.read(self._wakeup_r, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+            # Checked after the wakeups are read, or that of stop could be
+            # lost before waiting for the next one
+            if not self._active:
+                break
+            self._collect()
+            self._check_workers()
+            self._dispatch()
+            with self._lock:
+                if not self._backlog and not self._running:
+                    self._idle.set()
+                deadlines = [d for _, _, d in self._running.values()
+                             if d is not None]
+            # Wake up when a file is started, finishes or times out, or is
+            # submitted
+            timeout = None
+            if len(self._running) > 0:
+                timeout = _check_interval
+            if len(deadlines) > 0:
+                timeout = min(timeout,
+                              max(min(deadlines) - time.monotonic(), 0))
+            multiprocessing.connection.wait(
+                [self._wakeup_r, self._started_r], timeout=timeout)
+        self._pool.terminate()
+        with self._lock:
+            self._running.clear()
+            self._space.notify_all()
+        self._idle.set()
+
+    def start(self):
+        self._active = True
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.start()
+
+    def stop(self):
+        self._active = False
+        self._wakeup()
+
+    def join(self):
+        self._thread.join()
+        _logger.debug('Analysis pool finished')
+
+    def drain(self):
+        # Waits until every file submitted has been analyzed, or the pool is
+        # stopped
+        self._idle.wait()
+
+
+class Manifest:
+    # Files analyzed by a bulk run, with the parameters used and the size and
+    # modification time they had. It is saved every few seconds, so that an
+    # interrupted run resumes where it stopped, and files are analyzed again
+    # only if they or the parameters changed.
+    _save_interval = 5
+
+    def __init__(self, path: str, params: dict):
+        self._path = path
+        self._params = params
+        self._files = self._read()
+        self._lock = threading.Lock()
+        self._last_save = time.monotonic()
+
+    def _read(self):
+        try:
+            with open(self._path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            _logger.warning('Ignoring corrupt manifest %s', self._path)
+            return {}
+
+    @staticmethod
+    def _stat(video):
+        st = os.stat(video)
+        return {'size': st.st_size, 'mtime': st.st_mtime}
+
+    def current(self, video: str) -> bool:
+        entry = self._files.get(video)
+        return (entry is not None and entry['params'] == self._params and
+                {k: entry[k] for k in ('size', 'mtime')} ==
+                Manifest._stat(video))
+
+    def record(self, video: str, success: bool):
+        # Called from the dispatcher thread of the pool, which must go on
+        if not success:
+            return
+        try:
+            stat = Manifest._stat(video)
+        except OSError as e:
+            _logger.warning('Not recording %s in the manifest: %s', video, e)
+            return
+        with self._lock:
+            self._files[video] = dict(params=self._params, **stat)
+            if time.monotonic() - self._last_save >= Manifest._save_interval:
+                self._save()
+
+    def _save(self):
+        tmp = f'{self._path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._files, f)
+        os.replace(tmp, self._path)
+        self._last_save = time.monotonic()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+
+def list_segments(root: str):
+    # Videos recorded by the local storage, skipping the motion pictures
+    for r, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if d != 'motion')
+        for f in sorted(files):
+            if os.path.splitext(f)[1] == '.mkv':
+                yield os.path.join(r, f)
+
+
+def build_iterator(path: str, scale=1.0, snapshot_width=None):
+    # Gray frames for analysis, one per second, and with snapshot_width
+    # their color version of that width, from a single decode
     video_attr = ffmpeg.probe(path)['streams'][0]
-    width = int(video_attr['width'] * scale)
-    height = int(video_attr['height'] * scale)
     f_rate = ast.parse(video_attr['r_frame_rate'], mode='eval').body
     fps = f_rate.left.n // f_rate.right.n
-    # Open video with ffmpeg
-    ffmpeg_pipeline = ffmpeg.input(path, v='quiet')
-    # Apply framestep filter to reduce fps down to 1
-    ffmpeg_pipeline = ffmpeg_pipeline.filter('framestep', step=fps)
-    # Apply scale filter if necessary
-    if scale < 1:
-        ffmpeg_pipeline = ffmpeg_pipeline.filter(
-            'scale',
-            width=width,
-            height=height
-        )
-    # Create piped output
-    ffmpeg_pipeline = ffmpeg_pipeline.output(
-        'pipe:',
-        format='rawvideo',
-        pix_fmt='gray8'
+    return FrameIterator(
+        None,
+        video_attr['width'],
+        video_attr['height'],
+        fps,
+        scale,
+        source=path,
+        snapshot_width=snapshot_width
     )
-    # Loop
-    process = ffmpeg_pipeline.run_async(pipe_stdout=True)
-    while True:
-        in_bytes = process.stdout.read(height * width)
-        if not in_bytes:
-            break
-        frame = (
-            np
-            .frombuffer(in_bytes, np.uint8)
-            .reshape([height, width])
-        )
-        yield frame
 
 
-def run_motion_algorithm(path: str, scale: float, threshold: float,
-                         min_area: float, cooldown: int):
+def run_motion_algorithm(path: str, algorithm: str, scale: float,
+                         threshold: float, min_area: float, cooldown: float,
+                         quality=90, width=None):
     _logger.debug(path)
     # Run the motion detection algorithm
-    events = motion.basic_motion(
-        lambda: build_iterator(path, scale),
-        threshold,
-        min_area,
-        cooldown,
-        False
-    )
-    # Write detected frames with motion as pictures
+    detector = detectors[algorithm](threshold, min_area)
+    frame_iter = build_iterator(path, scale, width)
+    # build_iterator samples one frame per second
+    events = motion_events(frame_iter, detector, cooldown, rate=1)
+    # Write detected frames with motion as pictures, replacing those of a
+    # previous analysis
     events_path = os.path.join(os.path.dirname(path), 'motion')
     if not os.path.isdir(events_path):
         os.makedirs(events_path, 0o755)
-    for (n, frame) in events:
-        image_path = os.path.join(
-            events_path,
-            f'{os.path.basename(os.path.splitext(path)[0])}-{n}.jpg'
-        )
-        _logger.debug('Writting image %s', image_path)
-        cv2.imwrite(image_path, frame)
-    _logger.debug('Completed execution for file %s', path)
+    base = os.path.basename(os.path.splitext(path)[0])
+    for old in glob.glob(os.path.join(glob.escape(events_path),
+                                      f'{glob.escape(base)}-*.jpg')):
+        os.remove(old)
+    # Pictures are encoded while detection goes on, in color if a snapshot
+    # width was given
+    snapshots = SnapshotWriter(quality)
+    try:
+        for (n, frame, boxes) in events:
+            color = frame_iter.color()
+            if color is not None:
+                # Both sizes are rounded, so each axis has its own ratio
+                sx = color.shape[1] / frame.shape[1]
+                sy = color.shape[0] / frame.shape[0]
+                boxes = boxes * [sx, sy, sx, sy]
+                frame = color
+            snapshots.write(os.path.join(events_path, f'{base}-{n}.jpg'),
+                            frame, boxes)
+    finally:
+        snapshots.close()
+    _logger.debug('Completed execution for file %s, %.2f ms per frame',
+                  path, detector.cost() * 1000)
+
+
+def reanalyze(args, handler):
+    # Analyzes again every video recorded under the paths, except those
+    # already analyzed with the same parameters
+    params = {k: getattr(args, k) for k in
+              ('algorithm', 'scale', 'threshold', 'min_area', 'cooldown',
+               'jpeg_quality', 'snapshot_width')}
+    manifest = Manifest(args.manifest, params)
+    videos = [v for p in args.paths for v in list_segments(p)
+              if not manifest.current(v)]
+    _logger.info('%d videos to analyze', len(videos))
+    pool = AnalysisPool(handler, args.workers, args.timeout,
+                        args.max_backlog, manifest.record)
+    # Interrupted runs keep the progress made
+    signal.signal(signal.SIGTERM, lambda *_: pool.stop())
+    signal.signal(signal.SIGINT, lambda *_: pool.stop())
+    pool.start()
+    for v in videos:
+        pool.submit(v)
+    pool.drain()
+    pool.stop()
+    pool.join()
+    manifest.save()
+
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
+    parser.add_argument('--algorithm', choices=list(detectors),
+                        default='basic')
     parser.add_argument('--scale', type=float)
     parser.add_argument('--threshold', type=float)
     parser.add_argument('--min-area', type=float)
-    parser.add_argument('--cooldown', type=int)
+    parser.add_argument('--cooldown', type=float)
+    parser.add_argument('--jpeg-quality', type=int, default=90)
+    parser.add_argument('--snapshot-width', type=int,
+                        help='pictures are taken in color from the decoded '
+                             'frames, scaled down to this width, instead of '
+                             'from the gray frames analyzed')
+    parser.add_argument('--workers', type=int,
+                        help='files analyzed at once, one per core by default')
+    parser.add_argument('--timeout', type=float,
+                        help='seconds before the analysis of a file is killed')
+    parser.add_argument('--max-backlog', type=int, default=1024,
+                        help='files waiting before submitting more blocks')
+    parser.add_argument('--reanalyze', action='store_true',
+                        help='analyze the videos already stored in the '
+                             'paths instead of waiting for new ones')
+    parser.add_argument('--manifest', default='md-manifest.json',
+                        help='progress of --reanalyze, to resume it')
     parser.add_argument('paths', metavar='PATH', type=str, nargs='+')
     return parser.parse_args()
 
@@ -123,19 +442,32 @@ if __name__ == '__main__':
     )
     # Parse arguments
     args = parse_args()
-    # Listen for new videos inside the paths provided
-    l = Listener(
-        lambda p: run_motion_algorithm(
-            p,
-            args.scale,
-            args.threshold,
-            args.min_area,
-            args.cooldown
-        )
+    # Sent to the worker processes, so it must be picklable
+    handler = functools.partial(
+        run_motion_algorithm,
+        algorithm=args.algorithm,
+        scale=args.scale,
+        threshold=args.threshold,
+        min_area=args.min_area,
+        cooldown=args.cooldown,
+        quality=args.jpeg_quality,
+        width=args.snapshot_width
     )
+    if args.reanalyze:
+        reanalyze(args, handler)
+        sys.exit(0)
+    # Analyze new videos in parallel, out of the notifier thread
+    pool = AnalysisPool(handler, args.workers, args.timeout,
+                        args.max_backlog)
+    # Listen for new videos inside the paths provided
+    l = Listener(pool.submit)
     for p in args.paths:
         l.add_path(p)
-    # Configure signal handler to exit execution
-    signal.signal(signal.SIGTERM, lambda *args: l.stop())
+    # Configure signal handler to exit execution, the threads are stopped
+    # once it has returned
+    signal.signal(signal.SIGTERM, lambda *_: pool.stop())
     # Start loop until interrupted by signal
+    pool.start()
     l.start()
+    pool.join()
+    l.stop()
@@ -0,0 +1,89 @@
+from abc import abstractmethod
+
+import cv2
+import numpy as np
+
+from libreeye.md.algorithms.detector import Detector
+
+# Frames remembered by the background subtractors
+_history = 500
+# Frames the background subtractors learn from before detecting anything
+_warmup = 10
+
+
+class DiffDetector(Detector):
+    # Compares each blurred frame against the previous one only. The
+    # cheapest algorithm, but slow movements may go unnoticed.
+    def __init__(self, delta, min_area, zones=None):
+        super().__init__(delta, min_area, zones)
+        self._previous = None
+        self._diff = None
+
+    def _allocate_images(self, shape):
+        self._previous = np.empty(shape, np.uint8)
+        self._diff = np.empty(shape, np.uint8)
+
+    def _start(self, frame):
+        np.copyto(self._previous, self._blur(frame))
+
+    def _foreground(self, frame, detect):
+        self._blur(frame)
+        cv2.absdiff(self._blurred, self._previous, dst=self._diff)
+        # The current frame is the previous one of the next
+        self._blurred, self._previous = self._previous, self._blurred
+        if not detect:
+            return None
+        return self._threshold(self._diff)
+
+
+class _SubtractorDetector(Detector):
+    # Models every pixel of the background from the history of its values.
+    # The subtractor decides which pixels changed, so zones keep their own
+    # minimum area but share the threshold of the camera.
+    def __init__(self, delta, min_area, zones=None):
+        super().__init__(delta, min_area, zones)
+        self._subtractor = None
+        self._foreground_mask = None
+        self._learned = 0
+
+    @abstractmethod
+    def _create(self):
+        # Returns the OpenCV background subtractor
+        pass
+
+    def _allocate_images(self, shape):
+        self._subtractor = self._create()
+        self._foreground_mask = np.empty(shape, np.uint8)
+        self._learned = 0
+
+    def _start(self, frame):
+        self._subtractor.apply(self._blur(frame), self._foreground_mask)
+        self._learned = 1
+
+    def _foreground(self, frame, detect):
+        self._subtractor.apply(self._blur(frame), self._foreground_mask)
+        self._learned += 1
+        if not detect or self._learned < _warmup:
+            return None
+        return self._foreground_mask
+
+
+class MOG2Detector(_SubtractorDetector):
+    # Mixture of gaussians per pixel, threshold in standard deviations
+    def _create(self):
+        return cv2.createBackgroundSubtractorMOG2(
+            history=_history,
+            varThreshold=self._delta ** 2,
+            detectShadows=False
+        )
+
+
+class KNNDetector(_SubtractorDetector):
+    # Nearest neighbours among the past values of each pixel, threshold in
+    # pixel values
+    def _create(self):
+        return cv2.createBackgroundSubtractorKNN(
+            history=_history,
+            dist2Threshold=self._delta ** 2,
+            detectShadows=False
+        )
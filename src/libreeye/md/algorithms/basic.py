@@ -1,83 +1,97 @@
-import time
-
 import cv2
+import numpy as np
 
-from libreeye.md.iterator import FrameIterator
+from libreeye.md.algorithms.detector import Detector
 
-cv2.setUseOptimized(True)
+# Downscaling of the prefilter
+_coarse_factor = 8
 
 
-def basic_motion(frame_iter, delta, min_area, cooldown, debug):
+class BasicDetector(Detector):
     # https://github.com/YaoQ/motion-detection-with-opencv/blob/
     # e040c1a77a2545136efb35fa873443b34cde2fa0/motion-detector.py
-    # initialize the camera and grab a reference to the raw camera capture
-    avg = None
-    last_motion = -cooldown
-    # capture frames from the camera
-    for frame_num, frame in enumerate(frame_iter):
-        # assume no motion by default
-        frame_has_motion = False
-        # blur frame
-        gray = cv2.GaussianBlur(frame, (21, 21), 0)
-        # if the average frame is None, initialize it
-        if avg is None:
-            avg = gray.copy().astype("float")
-            continue
-        # accumulate the weighted average between the current and previous
-        cv2.accumulateWeighted(gray, avg, 0.5)
-        # check to see if enough time has passed between uploads
-        if frame_num - last_motion < cooldown:
-            continue
-        # compute the difference between the current frame and running average
-        frame_delta = cv2.absdiff(gray, cv2.convertScaleAbs(avg))
-        # threshold the delta image, dilate the thresholded image to fill
-        # in holes, then find contours on thresholded image
-        thresh = cv2.threshold(frame_delta, delta, 255, cv2.THRESH_BINARY)[1]
-        thresh = cv2.dilate(thresh, None, iterations=2)
-        cnts, _ = cv2.findContours(
-            thresh,
-            cv2.RETR_EXTERNAL,
-            cv2.CHAIN_APPROX_SIMPLE
-        )
-        # loop over the contours
-        for c in cnts:
-            # if the contour is too small, ignore it
-            if cv2.contourArea(c) < min_area:
-                continue
-            frame_has_motion = True
-            # compute the bounding box for the contour, draw it on the frame,
-            # and update the text
-            (x, y, w, h) = cv2.boundingRect(c)
-            cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
-        # check to see if there is motion
-        if frame_has_motion:
-            last_motion = frame_num
-            yield frame
-        # check to see if the frames should be displayed to screen
-        if debug:
-            # display the security feed
-            cv2.imshow("Window", frame)
-            cv2.waitKey(1)
+    # Compares each blurred frame against a running average of the previous
+    # ones. With prefilter, frames first go through a cheap test at 1/8 of
+    # the resolution, and only those that may contain motion are blurred and
+    # searched for contours.
+    def __init__(self, delta, min_area, zones=None, prefilter=False):
+        super().__init__(delta, min_area, zones)
+        self._prefilter = prefilter
+        self._avg = None
+        self._avg_u8 = None
+        self._diff = None
+        # Prefilter state
+        self._small = None
+        self._small_avg = None
+        self._small_diff = None
+        self._last = None
+        self._stale = False
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.threshold(), config.min_area(), config.zones(),
+                   config.prefilter())
 
+    def _allocate_images(self, shape):
+        self._avg = np.empty(shape, np.float64)
+        self._avg_u8 = np.empty(shape, np.uint8)
+        self._diff = np.empty(shape, np.uint8)
+        if self._prefilter:
+            small = (max(shape[0] // _coarse_factor, 1),
+                     max(shape[1] // _coarse_factor, 1))
+            self._small = np.empty(small, np.uint8)
+            self._small_avg = np.empty(small, np.float32)
+            self._small_diff = np.empty(small, np.uint8)
+            self._last = np.empty(shape, np.uint8)
+            self._stale = False
+            # The most sensitive zone decides, with half its threshold and a
+            # quarter of its area to make up for the averaging
+            deltas, areas = [self._delta], [self._min_area]
+            if self._zones is not None:
+                deltas = [z.threshold() for z in self._zone_configs]
+                areas = [z.min_area() for z in self._zones.zones()]
+            self._coarse_delta = min(deltas) / 2
+            self._coarse_area = max(
+                min(areas) / 4 / _coarse_factor ** 2, 1)
 
-class MotionDetection():
-    def __init__(self, config, frame_iter, logfile):
-        self._scale = config.resolution_scale()
-        self._threshold = config.threshold()
-        self._min_area = config.min_area()
-        self._cooldown = config.cooldown()
-        self._iter = frame_iter
-        self._logfile = logfile
+    def _start(self, frame):
+        self._avg[...] = self._blur(frame)
+        if self._prefilter:
+            cv2.resize(frame, self._small.shape[::-1], dst=self._small,
+                       interpolation=cv2.INTER_AREA)
+            self._small_avg[...] = self._small
 
-    def run(self):
-        f = open(self._logfile, 'a')
-        # Run the motion detection algorithm
-        for frame in basic_motion(
-            self._iter,
-            self._threshold,
-            self._min_area,
-            self._cooldown,
-            False
-        ):
-            print(time.asctime(), file=f)
-            f.flush()
+    def _candidate(self, frame):
+        # Whether the downscaled frame changed enough against its own
+        # running average for the frame to possibly contain motion
+        cv2.resize(frame, self._small.shape[::-1], dst=self._small,
+                   interpolation=cv2.INTER_AREA)
+        cv2.accumulateWeighted(self._small, self._small_avg, 0.5)
+        cv2.convertScaleAbs(self._small_avg, dst=self._small_diff)
+        cv2.absdiff(self._small, self._small_diff, dst=self._small_diff)
+        cv2.threshold(self._small_diff, self._coarse_delta, 255,
+                      cv2.THRESH_BINARY, dst=self._small_diff)
+        return cv2.countNonZero(self._small_diff) >= self._coarse_area
+
+    def _foreground(self, frame, detect):
+        if self._prefilter:
+            if not self._candidate(frame) or not detect:
+                # Static frame, keep it to catch up with the running average
+                # when the next candidate comes
+                np.copyto(self._last, frame)
+                self._stale = True
+                return None
+            if self._stale:
+                # With a weight of 0.5, the running average of a static
+                # scene is the last frame
+                self._avg[...] = self._blur(self._last)
+                self._stale = False
+        self._blur(frame)
+        # accumulate the weighted average between the current and previous
+        cv2.accumulateWeighted(self._blurred, self._avg, 0.5)
+        if not detect:
+            return None
+        # compute the difference between the current frame and running average
+        cv2.convertScaleAbs(self._avg, dst=self._avg_u8)
+        cv2.absdiff(self._blurred, self._avg_u8, dst=self._diff)
+        return self._threshold(self._diff)
@@ -0,0 +1,178 @@
+from abc import ABC, abstractmethod
+import time
+
+import cv2
+import numpy as np
+
+from libreeye.md.zones import Zones
+
+cv2.setUseOptimized(True)
+_blur_size = 21
+# Weight of the last frame in the measured cost
+_cost_weight = 0.05
+_no_boxes = np.empty((0, 4), np.int32)
+
+
+class Detector(ABC):
+    # Common part of the algorithms that compare decoded frames. All the
+    # working images are allocated once per resolution and every OpenCV call
+    # writes into them, so processing a frame does not allocate anything but
+    # the statistics of the blobs. With zones, only the region around them is
+    # processed, pixels outside them are ignored, and each zone has its own
+    # minimum area and, for the algorithms that threshold differences, its
+    # own threshold.
+    # Subclasses turn each frame into an image of changed pixels, which is
+    # dilated and split into blobs here. Blobs are found by a single
+    # connected components pass and filtered with array operations, so the
+    # cost does not grow with their number.
+    def __init__(self, delta, min_area, zones=None):
+        self._delta = delta
+        self._min_area = min_area
+        self._zone_configs = zones or []
+        self._shape = None
+        self._zones = None
+        self._crop = (slice(None), slice(None))
+        self._deltas = None
+        self._zone_masks = None
+        self._blurred = None
+        self._changed = None
+        self._mask = None
+        self._labels = None
+        # Pixels in motion in the last frame
+        self._score = 0
+        # Seconds per frame, averaged over the last frames
+        self._cost = 0.0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.threshold(), config.min_area(), config.zones())
+
+    def _allocate(self, shape):
+        self._shape = shape
+        self._zones = None
+        self._crop = (slice(None), slice(None))
+        if len(self._zone_configs) > 0:
+            self._zones = Zones(self._zone_configs, shape)
+        # Zones too small for the resolution are left out, if all of them are
+        # the whole frame is watched
+        if self._zones is not None and len(self._zones.zones()) == 0:
+            self._zones = None
+        if self._zones is not None:
+            # Blurring takes pixels up to half the kernel size away
+            self._crop = self._zones.crop(_blur_size // 2)
+            self._deltas = self._zones.deltas()[self._crop]
+            shape = self._deltas.shape
+            self._changed = np.empty(shape, bool)
+            self._zone_masks = [
+                np.empty(z.mask()[z.box()].shape, np.uint8)
+                for z in self._zones.zones()
+            ]
+        self._blurred = np.empty(shape, np.uint8)
+        self._mask = np.empty(shape, np.uint8)
+        # Shared by the zones, which are all smaller than the region
+        self._labels = np.empty(shape[0] * shape[1], np.int32)
+        self._allocate_images(shape)
+
+    def _allocate_images(self, shape) -> None:
+        # Working images of the algorithm, shape is that of the region
+        # processed
+        pass
+
+    def _start(self, frame) -> None:
+        # Called with the first frame of a resolution
+        pass
+
+    @abstractmethod
+    def _foreground(self, frame, detect):
+        # Returns an image whose non zero pixels changed, or None when
+        # detect is not set or the frame cannot contain motion
+        pass
+
+    def _blur(self, frame):
+        cv2.GaussianBlur(frame, (_blur_size, _blur_size), 0,
+                         dst=self._blurred)
+        return self._blurred
+
+    def _threshold(self, diff):
+        # Pixels of diff above the threshold of the frame, or of their zone
+        if self._zones is None:
+            cv2.threshold(diff, self._delta, 255, cv2.THRESH_BINARY,
+                          dst=diff)
+            return diff
+        np.greater(diff, self._deltas, out=self._changed)
+        return self._changed.view(np.uint8)
+
+    def reset(self) -> None:
+        # Forget the background, the next frame starts a new one
+        self._shape = None
+
+    def cost(self) -> float:
+        return self._cost
+
+    def score(self) -> int:
+        # Area of the boxes returned by the last call to feed
+        return self._score
+
+    def _blobs(self, mask, min_area, offset):
+        # Bounding boxes of the blobs of mask with at least min_area pixels,
+        # as rows of x, y, width and height
+        labels = self._labels[:mask.size].reshape(mask.shape)
+        _, _, stats, _ = cv2.connectedComponentsWithStats(
+            mask, labels, connectivity=8, ltype=cv2.CV_32S)
+        # The first component is the background
+        stats = stats[1:]
+        blobs = stats[stats[:, cv2.CC_STAT_AREA] >= min_area]
+        self._score += int(blobs[:, cv2.CC_STAT_AREA].sum())
+        boxes = blobs[:, :4]
+        boxes[:, 0] += offset[1]
+        boxes[:, 1] += offset[0]
+        return boxes
+
+    def _zone_boxes(self):
+        boxes = [_no_boxes]
+        for z, zone_mask in zip(self._zones.zones(), self._zone_masks):
+            rows, cols = z.box()
+            # The zone box, relative to the cropped region
+            box = (slice(rows.start - self._crop[0].start,
+                         rows.stop - self._crop[0].start),
+                   slice(cols.start - self._crop[1].start,
+                         cols.stop - self._crop[1].start))
+            np.logical_and(self._mask[box], z.mask()[z.box()],
+                           out=zone_mask.view(bool))
+            boxes.append(self._blobs(zone_mask, z.min_area(),
+                                     (rows.start, cols.start)))
+        return np.concatenate(boxes)
+
+    def _feed(self, frame, detect):
+        if self._shape != frame.shape:
+            self._allocate(frame.shape)
+            self._start(frame[self._crop])
+            return _no_boxes
+        changed = self._foreground(frame[self._crop], detect)
+        if not detect or changed is None:
+            return _no_boxes
+        # dilate the changed pixels to fill in holes, then find blobs
+        cv2.dilate(changed, None, dst=self._mask, iterations=2)
+        if self._zones is None:
+            return self._blobs(self._mask, self._min_area, (0, 0))
+        return self._zone_boxes()
+
+    def feed(self, frame, detect=True) -> np.ndarray:
+        # Updates the background with frame and, if detect is set, returns
+        # the bounding boxes of the areas in motion, one per row
+        start = time.perf_counter()
+        self._score = 0
+        boxes = self._feed(frame, detect)
+        elapsed = time.perf_counter() - start
+        self._cost += _cost_weight * (elapsed - self._cost)
+        return boxes
+
+
+def draw_boxes(frame, boxes, color=(0, 255, 0)) -> None:
+    # Draws all the boxes returned by Detector.feed in a single call
+    x, y, w, h = (boxes[:, i] for i in range(4))
+    corners = np.stack([
+        np.stack([x, y], 1), np.stack([x + w, y], 1),
+        np.stack([x + w, y + h], 1), np.stack([x, y + h], 1)
+    ], 1).astype(np.int32)
+    cv2.polylines(frame, list(corners), True, color, 2)
@@ -0,0 +1,90 @@
+import logging
+import time
+
+import cv2
+
+from libreeye.md.algorithms.background import DiffDetector, KNNDetector, \
+    MOG2Detector
+from libreeye.md.algorithms.basic import BasicDetector
+from libreeye.md.algorithms.detector import draw_boxes
+from libreeye.md.events import EventLog
+
+_logger = logging.getLogger(__name__)
+# Algorithms on decoded frames, by the name used in [motion]
+detectors = {
+    'basic': BasicDetector,
+    'diff': DiffDetector,
+    'mog2': MOG2Detector,
+    'knn': KNNDetector,
+}
+# Seconds between reports of the cost of the algorithm
+_cost_interval = 600
+
+
+def create_detector(config):
+    algorithm = config.algorithm()
+    if algorithm not in detectors:
+        raise ValueError(f'unknown motion algorithm {algorithm}')
+    return detectors[algorithm].from_config(config)
+
+
+def motion_events(frame_iter, detector, cooldown, debug=False, rate=None):
+    # Yields the number, frame and boxes in motion of the frames with motion,
+    # at least cooldown seconds apart. Frames of a recording are rate per
+    # second, so their time comes from their number; live frames come at a
+    # varying rate, so the clock is used instead.
+    last_motion = None
+    # capture frames from the camera
+    for frame_num, frame in enumerate(frame_iter):
+        if rate is None:
+            now = time.monotonic()
+        else:
+            now = frame_num / rate
+        # check to see if enough time has passed between uploads
+        boxes = detector.feed(frame, last_motion is None or
+                              now - last_motion >= cooldown)
+        # check to see if the frames should be displayed to screen; frames
+        # may live in shared memory, so only draw on them when debugging
+        if debug:
+            draw_boxes(frame, boxes)
+            cv2.imshow("Window", frame)
+            cv2.waitKey(1)
+        # check to see if there is motion
+        if len(boxes) > 0:
+            last_motion = now
+            yield frame_num, frame, boxes
+
+
+class MotionDetection():
+    def __init__(self, config, frame_iter, camera, state=None):
+        self._algorithm = config.algorithm()
+        self._detector = create_detector(config)
+        self._cooldown = config.cooldown()
+        self._iter = frame_iter
+        self._camera = camera
+        self._events = config.events()
+        self._event_gap = config.event_gap()
+        self._state = state
+
+    def _frames(self):
+        # Reports the cost of the algorithm now and then, so that it can be
+        # weighed against the others for each camera
+        next_report = time.monotonic() + _cost_interval
+        for frame in self._iter:
+            yield frame
+            if time.monotonic() >= next_report:
+                next_report += _cost_interval
+                _logger.info('motion algorithm %s takes %.2f ms per frame',
+                             self._algorithm, self._detector.cost() * 1000)
+
+    def run(self):
+        events = EventLog(self._events, self._camera, self._event_gap)
+        try:
+            # Run the motion detection algorithm
+            for _, _, boxes in motion_events(self._frames(), self._detector,
+                                             self._cooldown):
+                if self._state is not None:
+                    self._state.notify()
+                events.detection(time.time(), self._detector.score(), boxes)
+        finally:
+            events.close()
@@ -0,0 +1,110 @@
+import logging
+import os
+import time
+
+import numpy as np
+
+from libreeye.md.events import EventLog
+
+try:
+    import av
+except ImportError:
+    av = None
+
+_logger = logging.getLogger(__name__)
+_read_size = 2**16
+
+
+class VectorIterator:
+    # Feeds the camera stream, as received, to a libavcodec decoder that
+    # exports the motion vectors of every frame, and yields them as arrays
+    # with one row per block. Frames are never converted nor copied out of
+    # the decoder, which is much cheaper than producing gray pixels. The
+    # stream goes through a pipe so that decoding happens in the motion
+    # detection process.
+    def __init__(self, input_format):
+        if av is None:
+            raise RuntimeError('motion vectors require PyAV (pip install av)')
+        self._input_format = input_format
+        self._read_fd, self._write_fd = os.pipe()
+
+    def started(self) -> None:
+        # Called by the camera process once the reader has been forked
+        os.close(self._read_fd)
+        self._read_fd = None
+
+    def __iter__(self):
+        # Runs in the motion detection process
+        os.close(self._write_fd)
+        self._write_fd = None
+        codec = av.CodecContext.create(self._input_format, 'r')
+        codec.options = {'flags2': '+export_mvs'}
+        _logger.debug('entering vector iterator loop')
+        with open(self._read_fd, 'rb', buffering=0) as stream:
+            data = stream.read(_read_size)
+            while len(data) > 0:
+                for packet in codec.parse(data):
+                    for frame in codec.decode(packet):
+                        vectors = frame.side_data.get('MOTION_VECTORS')
+                        # Intra frames have none
+                        if vectors is not None:
+                            yield vectors.to_ndarray()
+                data = stream.read(_read_size)
+        _logger.debug('vector iterator loop exited')
+
+    def write(self, frame) -> None:
+        if self._write_fd is None:
+            return
+        # Pipe writes may be cut short, and any lost byte corrupts the stream
+        view = memoryview(frame)
+        while len(view) > 0:
+            view = view[os.write(self._write_fd, view):]
+
+    def pipe_fd(self):
+        return self._write_fd
+
+    def close(self):
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+            self._write_fd = None
+
+
+class VectorMotionDetection():
+    # Same events as MotionDetection, from the area of the blocks that moved
+    # more than Threshold pixels since their reference frame. Every frame is
+    # analyzed, so Cooldown is converted from seconds to frames.
+    def __init__(self, config, vector_iter, framerate, camera, state=None):
+        self._threshold = config.threshold()
+        self._min_area = config.min_area()
+        self._cooldown = config.cooldown() * framerate
+        self._iter = vector_iter
+        self._camera = camera
+        self._events = config.events()
+        self._event_gap = config.event_gap()
+        self._state = state
+
+    def _moving_area(self, vectors):
+        scale = np.maximum(vectors['motion_scale'], 1)
+        dx = vectors['motion_x'] / scale
+        dy = vectors['motion_y'] / scale
+        moving = dx * dx + dy * dy > self._threshold * self._threshold
+        area = vectors['w'].astype(np.int64) * vectors['h']
+        return int(area[moving].sum())
+
+    def run(self):
+        events = EventLog(self._events, self._camera, self._event_gap)
+        last_motion = -self._cooldown
+        try:
+            for frame_num, vectors in enumerate(self._iter):
+                if frame_num - last_motion < self._cooldown:
+                    continue
+                area = self._moving_area(vectors)
+                if area < self._min_area:
+                    continue
+                last_motion = frame_num
+                if self._state is not None:
+                    self._state.notify()
+                # Blocks are not grouped into boxes
+                events.detection(time.time(), area, [])
+        finally:
+            events.close()
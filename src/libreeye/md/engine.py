@@ -0,0 +1,247 @@
+import logging
+import multiprocessing
+import queue
+import signal
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from libreeye.md.events import EventLog
+from libreeye.md.ring import FrameRing
+from libreeye.md.state import MotionState
+from libreeye.md.zones import Zones
+
+_logger = logging.getLogger(__name__)
+# OpenCV limit on the number of channels of an image
+_max_channels = 512
+
+
+class BatchDetector:
+    # The basic motion algorithm run on the frames of several cameras of the
+    # same size at once. Frames are stacked as the channels of a single image,
+    # so every step is one OpenCV or NumPy call whatever the number of cameras.
+    # The motion score of a camera is its number of changed pixels.
+    def __init__(self, shape):
+        self._shape = tuple(shape)
+        self._names = []
+        self._initialized = np.empty((0,), bool)
+        self._allocate(0)
+
+    def _allocate(self, n):
+        shape = self._shape + (n,)
+        self._frames = np.zeros(shape, np.uint8)
+        self._blurred = np.empty(shape, np.uint8)
+        self._avg = np.empty(shape, np.float64)
+        self._avg_u8 = np.empty(shape, np.uint8)
+        self._diff = np.empty(shape, np.uint8)
+        self._deltas = np.empty(shape, np.uint8)
+        self._changed = np.empty(shape, bool)
+        self._mask = np.empty(shape, np.uint8)
+
+    def names(self):
+        return list(self._names)
+
+    def set_cameras(self, cameras) -> None:
+        # cameras maps each name to the threshold of every pixel; running
+        # averages are kept for the cameras that were already there
+        old_names = self._names
+        old_avg = self._avg
+        old_initialized = self._initialized
+        self._names = list(cameras)
+        self._initialized = np.zeros((len(self._names),), bool)
+        self._allocate(len(self._names))
+        for i, name in enumerate(self._names):
+            self._deltas[:, :, i] = cameras[name]
+            if name in old_names:
+                j = old_names.index(name)
+                self._avg[:, :, i] = old_avg[:, :, j]
+                self._initialized[i] = old_initialized[j]
+
+    def frame(self, index):
+        # Where the next frame of the camera at index has to be copied
+        return self._frames[:, :, index]
+
+    def mask(self, index):
+        return self._mask[:, :, index]
+
+    def run(self):
+        # Returns the motion score of every camera
+        if len(self._names) == 0:
+            return np.empty((0,), np.int64)
+        cv2.GaussianBlur(self._frames, (21, 21), 0, dst=self._blurred)
+        # New cameras start their running average at their first frame
+        for i in np.flatnonzero(~self._initialized):
+            self._avg[:, :, i] = self._blurred[:, :, i]
+            self._initialized[i] = True
+        cv2.accumulateWeighted(self._blurred, self._avg, 0.5)
+        cv2.convertScaleAbs(self._avg, dst=self._avg_u8)
+        cv2.absdiff(self._blurred, self._avg_u8, dst=self._diff)
+        # Every camera, or zone, has its own threshold
+        np.greater(self._diff, self._deltas, out=self._changed)
+        cv2.dilate(self._changed.view(np.uint8), None, dst=self._mask,
+                   iterations=2)
+        return np.count_nonzero(self._mask, axis=(0, 1))
+
+
+class _Camera:
+    def __init__(self, name, config, state, ring):
+        self.name = name
+        self.ring = ring
+        self.state = state
+        self.zones = None
+        if len(config.zones()) > 0:
+            self.zones = Zones(config.zones(), ring.shape())
+        if self.zones is not None and len(self.zones.zones()) > 0:
+            self.deltas = self.zones.deltas()
+        else:
+            self.zones = None
+            self.deltas = min(max(int(config.threshold()), 0), 255)
+        self.min_area = config.min_area()
+        self.cooldown = config.cooldown()
+        self.events = EventLog(config.events(), name, config.event_gap())
+        self.seq = 0
+        self.last_motion = -self.cooldown
+        self.detector = None
+
+
+class MotionEngine:
+    # Runs motion detection for all cameras in a single process. Cameras
+    # publish their decoded frames in polled frame rings and register them
+    # through a queue; every interval seconds the newest frame of each camera
+    # is gathered and scored by a BatchDetector per frame size. Motion states
+    # are created here, before the cameras are forked, so that both sides
+    # share them.
+    def __init__(self, config, interval):
+        self._interval = interval
+        self._configs = {
+            name: c.motion() for name, c in config.cameras().items()
+            if c.motion() is not None and c.motion().algorithm() == 'basic'
+        }
+        self._states = {name: MotionState() for name in self._configs}
+        self._registrations = multiprocessing.Queue()
+        self._process = None
+        # Engine process state
+        self._cameras = {}
+        self._detectors = {}
+
+    def state(self, name) -> MotionState:
+        return self._states.get(name)
+
+    def register(self, name, ring) -> None:
+        # Called from the camera process once its ring exists
+        self._registrations.put(
+            (name, ring.name(), ring.shape(), ring.slots()))
+
+    def _detector_for(self, camera):
+        # Cameras of the same size share a detector, up to the channel limit
+        shape = camera.ring.shape()
+        for key, detector in self._detectors.items():
+            if key[0] == shape and len(detector.names()) < _max_channels:
+                return detector
+        key = (shape, len(self._detectors))
+        self._detectors[key] = BatchDetector(shape)
+        return self._detectors[key]
+
+    def _update_detector(self, detector):
+        detector.set_cameras({
+            c.name: c.deltas
+            for c in self._cameras.values() if c.detector is detector
+        })
+
+    def _remove(self, name):
+        camera = self._cameras.pop(name)
+        camera.ring.detach()
+        camera.events.close()
+        self._update_detector(camera.detector)
+        _logger.debug('camera %s removed from motion engine', name)
+
+    def _add(self, name, ring_name, shape, slots):
+        if name in self._cameras:
+            self._remove(name)
+        if name not in self._configs:
+            _logger.warning('camera %s has no motion configuration', name)
+            return
+        ring = FrameRing.attach(ring_name, shape, slots)
+        camera = _Camera(name, self._configs[name], self._states[name], ring)
+        camera.detector = self._detector_for(camera)
+        self._cameras[name] = camera
+        self._update_detector(camera.detector)
+        _logger.debug('camera %s added to motion engine', name)
+
+    def _drain_registrations(self):
+        while True:
+            try:
+                self._add(*self._registrations.get(block=False))
+            except queue.Empty:
+                return
+
+    def _tick(self):
+        self._drain_registrations()
+        for name in [n for n, c in self._cameras.items() if c.ring.closed()]:
+            self._remove(name)
+        # Gather the newest frame of every camera
+        fresh = {}
+        for detector in self._detectors.values():
+            for i, name in enumerate(detector.names()):
+                camera = self._cameras[name]
+                seq = camera.ring.latest(detector.frame(i))
+                if seq != 0 and seq != camera.seq:
+                    camera.seq = seq
+                    fresh[name] = camera
+        # Score all of them, and report cameras with new frames only
+        now = time.monotonic()
+        for detector in self._detectors.values():
+            names = detector.names()
+            if not any(n in fresh for n in names):
+                continue
+            scores = detector.run()
+            for i, (name, score) in enumerate(zip(names, scores)):
+                camera = fresh.get(name)
+                if (camera is None or
+                        now - camera.last_motion < camera.cooldown or
+                        not self._motion(camera, score, detector.mask(i))):
+                    continue
+                camera.last_motion = now
+                camera.state.notify()
+                # The batched detector does not split motion into boxes
+                camera.events.detection(time.time(), score, [])
+
+    @staticmethod
+    def _motion(camera, score, mask):
+        if camera.zones is None:
+            return score >= camera.min_area
+        # Changed pixels never fall outside the zones, but dilation spreads
+        # them a little
+        return any(
+            np.count_nonzero(mask[z.box()][z.mask()[z.box()]]) >= z.min_area()
+            for z in camera.zones.zones()
+        )
+
+    def _run(self):
+        # Terminated by the daemon, or when it exits, after writing the
+        # pending events
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        _logger.debug('motion engine started')
+        next_tick = time.monotonic()
+        try:
+            while True:
+                self._tick()
+                next_tick += self._interval
+                time.sleep(max(next_tick - time.monotonic(), 0))
+        finally:
+            for camera in self._cameras.values():
+                camera.events.close()
+
+    def start(self) -> None:
+        self._process = multiprocessing.Process(
+            target=self._run, name='motion-engine', daemon=True)
+        self._process.start()
+
+    def stop(self) -> None:
+        if self._process is None:
+            return
+        self._process.terminate()
+        self._process.join()
+        self._process = None
@@ -0,0 +1,179 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import List, NamedTuple, Optional
+
+_logger = logging.getLogger(__name__)
+# Detections and segments waiting to be written, newer ones are dropped
+_queue_size = 1024
+# Seconds between commits to the database
+_commit_interval = 1.0
+_schema = '''
+CREATE TABLE IF NOT EXISTS events (
+    camera TEXT NOT NULL,
+    start_time REAL NOT NULL,
+    end_time REAL NOT NULL,
+    detections INTEGER NOT NULL,
+    peak_score REAL NOT NULL,
+    boxes TEXT NOT NULL,
+    segment TEXT,
+    segment_offset REAL
+);
+CREATE INDEX IF NOT EXISTS events_start ON events (start_time);
+CREATE INDEX IF NOT EXISTS events_camera_start ON events (camera, start_time);
+CREATE TABLE IF NOT EXISTS segments (
+    camera TEXT NOT NULL,
+    path TEXT NOT NULL,
+    start_time REAL NOT NULL,
+    end_time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS segments_camera_start
+    ON segments (camera, start_time);
+'''
+
+
+class Event(NamedTuple):
+    camera: str
+    start: float
+    end: float
+    detections: int
+    peak_score: float
+    # Boxes of the detection with the peak score, as x, y, width, height
+    boxes: List[List[int]]
+    # Segment recorded while the event started, and seconds into it
+    segment: Optional[str]
+    segment_offset: Optional[float]
+
+
+def _connect(path):
+    if os.path.dirname(path) != '':
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Every camera and motion process has its own connection
+    db = sqlite3.connect(path, timeout=30)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.executescript(_schema)
+    return db
+
+
+def query(path, start, end, camera=None) -> List[Event]:
+    # Events of camera, or of every camera, that started between start and
+    # end, as seconds since the epoch
+    db = _connect(path)
+    try:
+        sql = ('SELECT camera, start_time, end_time, detections, peak_score, '
+               'boxes, segment, segment_offset FROM events '
+               'WHERE start_time >= ? AND start_time < ?')
+        args = [start, end]
+        if camera is not None:
+            sql += ' AND camera = ?'
+            args.append(camera)
+        rows = db.execute(sql + ' ORDER BY start_time', args).fetchall()
+    finally:
+        db.close()
+    return [Event(r[0], r[1], r[2], r[3], r[4], json.loads(r[5]), r[6], r[7])
+            for r in rows]
+
+
+class EventLog:
+    # Records the motion of a camera in an SQLite database. Consecutive
+    # detections less than gap seconds apart are merged into a single event,
+    # which is linked to the segment recorded when it started. Callers only
+    # put detections and closed segments in a queue, merging and writing
+    # happen in a thread that commits in batches.
+    def __init__(self, path, camera, gap):
+        self._path = path
+        self._camera = camera
+        self._gap = gap
+        self._queue = queue.Queue(_queue_size)
+        self._thread = threading.Thread(
+            target=self._run, name=f'{camera}-events', daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            _logger.warning('event log queue is full, dropping %s', item[0])
+
+    def detection(self, when, score, boxes) -> None:
+        self._put(('detection', when, float(score),
+                   [[int(v) for v in b] for b in boxes]))
+
+    def segment(self, path, start, end) -> None:
+        self._put(('segment', path, start, end))
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    def _insert_event(self, db, event):
+        start, end, detections, score, boxes = event
+        segment = db.execute(
+            'SELECT path, start_time FROM segments WHERE camera = ? AND '
+            'start_time <= ? AND end_time > ? ORDER BY start_time DESC '
+            'LIMIT 1', (self._camera, start, start)
+        ).fetchone()
+        db.execute(
+            'INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (self._camera, start, end, detections, score, json.dumps(boxes),
+             segment[0] if segment is not None else None,
+             start - segment[1] if segment is not None else None)
+        )
+
+    def _insert_segment(self, db, path, start, end):
+        db.execute('INSERT INTO segments VALUES (?, ?, ?, ?)',
+                   (self._camera, path, start, end))
+        # Events written before the segment was closed
+        db.execute(
+            'UPDATE events SET segment = ?, segment_offset = start_time - ? '
+            'WHERE camera = ? AND segment IS NULL AND start_time >= ? AND '
+            'start_time < ?', (path, start, self._camera, start, end)
+        )
+
+    def _run(self):
+        db = _connect(self._path)
+        # start, end, detections, peak score and its boxes
+        event = None
+        pending = False
+        last_commit = time.monotonic()
+        running = True
+        while running:
+            try:
+                item = self._queue.get(timeout=_commit_interval)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                running = False
+            elif len(item) > 0 and item[0] == 'detection':
+                _, when, score, boxes = item
+                if event is not None and when - event[1] > self._gap:
+                    self._insert_event(db, event)
+                    pending = True
+                    event = None
+                if event is None:
+                    event = [when, when, 1, score, boxes]
+                else:
+                    event[1] = when
+                    event[2] += 1
+                    if score > event[3]:
+                        event[3], event[4] = score, boxes
+            elif len(item) > 0 and item[0] == 'segment':
+                self._insert_segment(db, *item[1:])
+                pending = True
+            # Events are written once no detection extends them
+            if event is not None and (
+                    not running or time.time() - event[1] > self._gap):
+                self._insert_event(db, event)
+                pending = True
+                event = None
+            now = time.monotonic()
+            if pending and (not running or
+                            now - last_commit >= _commit_interval):
+                db.commit()
+                pending = False
+                last_commit = now
+        db.close()
@@ -1,47 +1,223 @@
 import logging
 import numpy as np
 import os
+import subprocess
 import sys
+import threading
 
 import ffmpeg
 
 _logger = logging.getLogger(__name__)
 
 
+def _read_into(stream, view) -> bool:
+    # Fills view from stream, returns False on end of file
+    pos = 0
+    while pos < len(view):
+        n = stream.readinto(view[pos:])
+        if not n:
+            return False
+        pos += n
+    return True
+
+
+class FramePool:
+    # Preallocated frames that are recycled between reads, so that reading a
+    # frame neither allocates nor copies it. A frame yielded by frames() is
+    # only valid until the next one is requested; consumers that need it for
+    # longer take it with hold(), and give it back with release() once done.
+    def __init__(self, shape):
+        self._shape = tuple(shape)
+        self._free = []
+        self._held = set()
+
+    def _get(self):
+        if len(self._free) > 0:
+            return self._free.pop()
+        return np.empty(self._shape, np.uint8)
+
+    def hold(self, frame) -> None:
+        self._held.add(id(frame))
+
+    def release(self, frame) -> None:
+        self._held.discard(id(frame))
+        self._free.append(frame)
+
+    def frames(self, stream):
+        frame = self._get()
+        while _read_into(stream, memoryview(frame.reshape(-1))):
+            yield frame
+            # A held frame belongs to the consumer until released
+            if id(frame) in self._held:
+                frame = self._get()
+        self._free.append(frame)
+
+
+class ColorFrames:
+    # Color frames read by a thread from a second output of the same ffmpeg
+    # process, in step with the gray frames of a FrameIterator. The last
+    # slots frames are kept in buffers that are reused, and the reader waits
+    # for the iterator whenever it gets that far ahead.
+    def __init__(self, shape, slots=8):
+        self._shape = tuple(shape)
+        self._frames = [np.empty(self._shape, np.uint8) for _ in range(slots)]
+        self._cond = threading.Condition()
+        self._read = 0
+        self._consumed = 0
+        self._done = False
+        self._thread = None
+
+    def shape(self):
+        return self._shape
+
+    def start(self, fd) -> None:
+        self._read = 0
+        self._consumed = 0
+        self._done = False
+        self._thread = threading.Thread(
+            target=self._run, args=(fd,), daemon=True)
+        self._thread.start()
+
+    def _run(self, fd):
+        slots = len(self._frames)
+        with open(fd, 'rb', buffering=0) as stream:
+            while True:
+                with self._cond:
+                    self._cond.wait_for(
+                        lambda: self._read - self._consumed < slots - 1)
+                    frame = self._frames[self._read % slots]
+                if not _read_into(stream, memoryview(frame.reshape(-1))):
+                    break
+                with self._cond:
+                    self._read += 1
+                    self._cond.notify_all()
+        with self._cond:
+            self._done = True
+            self._cond.notify_all()
+
+    def advance(self) -> None:
+        # Called for every gray frame
+        with self._cond:
+            self._consumed += 1
+            self._cond.notify_all()
+
+    def stop(self) -> None:
+        # Lets the reader drain the pipe once there is no consumer left
+        with self._cond:
+            self._consumed = float('inf')
+            self._cond.notify_all()
+
+    def get(self):
+        # Color version of the last gray frame, valid until the next one
+        index = self._consumed - 1
+        with self._cond:
+            self._cond.wait_for(lambda: self._read > index or self._done)
+            if self._read <= index:
+                return None
+            return self._frames[index % len(self._frames)]
+
+
 class FrameIterator:
+    # Decodes the stream written to it, or the file source, into gray frames
+    # of the size given by scale, rate frames per second. With snapshot_width,
+    # the same decoded frames are also split into color frames of that width,
+    # which come out of a second pipe and are returned by color().
     def __init__(self, input_format, input_width, input_height,
-                 input_framerate, scale):
+                 input_framerate, scale, keyframes_only=False, rate=1,
+                 source=None, snapshot_width=None):
         super().__init__()
         self._input_format = input_format
+        self._keyframes_only = keyframes_only
         self._input_width = input_width
         self._scaled_width = round(input_width * scale)
         self._input_height = input_height
         self._scaled_height = round(input_height * scale)
         self._input_framerate = input_framerate
+        # Frames per second to decode
+        self._rate = rate
+        self._source = source
+        self._pool = FramePool(self.shape())
+        self._color = None
+        if snapshot_width is not None:
+            width = min(snapshot_width, input_width)
+            height = max(round(input_height * width / input_width), 1)
+            self._color = ColorFrames((height, width, 3))
+        self._ffmpeg = None
+
+    def shape(self):
+        return self._scaled_height, self._scaled_width
 
     def __iter__(self):
         self._ffmpeg_open()
         _logger.debug('entering frame iterator loop')
-        frame_bytes = self._ffmpeg.stdout.read(
-            self._scaled_height * self._scaled_width
-        )
-        while len(frame_bytes) > 0:
-            frame = (
-                np.frombuffer(frame_bytes, np.uint8)
-                .reshape([self._scaled_height, self._scaled_width])
-            )
-            yield frame
-            frame_bytes = self._ffmpeg.stdout.read(
-                self._scaled_height * self._scaled_width
-            )
+        try:
+            for frame in self._pool.frames(self._ffmpeg.stdout):
+                if self._color is not None:
+                    self._color.advance()
+                yield frame
+        finally:
+            if self._color is not None:
+                self._color.stop()
         _logger.debug('frame iterator loop exited')
+        self._ffmpeg.wait()
         self._ffmpeg = None
 
+    def hold(self, frame) -> None:
+        self._pool.hold(frame)
+
+    def release(self, frame) -> None:
+        self._pool.release(frame)
+
+    def color(self):
+        # Color version of the last frame, or None without snapshot_width
+        if self._color is None:
+            return None
+        return self._color.get()
+
+    def _ffmpeg_input(self, **kwargs):
+        if self._source is not None:
+            return ffmpeg.input(self._source, v='warning', **kwargs)
+        return ffmpeg.input('pipe:', f=self._input_format, v='warning',
+                            **kwargs)
+
     def _ffmpeg_open(self):
         # Open video with ffmpeg
-        pipeline = ffmpeg.input('pipe:', f='mjpeg', v='warning')
-        # Apply framestep filter to reduce fps down to 1
-        pipeline = pipeline.filter('framestep', step=self._input_framerate)
+        if self._keyframes_only:
+            # The decoder drops every frame but keyframes without decoding
+            # them; timestamps are needed to keep at most rate per second
+            options = {'skip_frame': 'nokey'}
+            if self._source is None:
+                options['framerate'] = self._input_framerate
+            pipeline = self._ffmpeg_input(**options)
+            if self._source is None:
+                # A raw stream has no timestamps, and the parser numbers the
+                # keyframes left as consecutive frames, so live ones are
+                # stamped with the time they are decoded at
+                pipeline = pipeline.filter('settb', 'AVTB').filter(
+                    'setpts', 'RTCTIME-RTCSTART')
+            # One frame per slot of 1 / rate seconds, as keyframes that come
+            # a little early would be dropped if measured from the last one
+            rate = self._rate
+            pipeline = pipeline.filter(
+                'select',
+                f'isnan(prev_selected_t)+'
+                f'gt(floor(t*{rate}),floor(prev_selected_t*{rate}))'
+            )
+        else:
+            pipeline = self._ffmpeg_input()
+            # Apply framestep filter to reduce fps down to rate
+            pipeline = pipeline.filter(
+                'framestep',
+                step=max(round(self._input_framerate / self._rate), 1)
+            )
+        # Every frame is decoded once, and split for the color output
+        color = None
+        if self._color is not None:
+            split = pipeline.split()
+            pipeline, color = split[0], split[1]
+            height, width = self._color.shape()[:2]
+            if self._input_width > width:
+                color = color.filter('scale', width=width, height=height)
         # Apply scale filter if necessary
         if (self._input_width > self._scaled_width or
                 self._input_height > self._scaled_height):
@@ -50,16 +226,40 @@ class FrameIterator:
                 width=self._scaled_width,
                 height=self._scaled_height
             )
-        # Create ffmpeg process
-        self._ffmpeg = (
-            pipeline.output('pipe:', f='rawvideo', pix_fmt='gray8')
-            .run_async(pipe_stdin=True, pipe_stdout=True)
+        # Create ffmpeg process, which must not duplicate frames to make up
+        # for the skipped ones
+        outputs = [pipeline.output('pipe:', f='rawvideo', pix_fmt='gray8',
+                                   fps_mode='passthrough')]
+        fds = ()
+        if color is not None:
+            color_r, color_w = os.pipe()
+            outputs.append(color.output(f'pipe:{color_w}', f='rawvideo',
+                                        pix_fmt='bgr24',
+                                        fps_mode='passthrough'))
+            fds = (color_w,)
+        args = ffmpeg.merge_outputs(*outputs).compile()
+        self._ffmpeg = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE if self._source is None
+            else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            pass_fds=fds
         )
+        if color is not None:
+            os.close(color_w)
+            self._color.start(color_r)
 
     def write(self, frame) -> None:
         if self._ffmpeg is not None:
             self._ffmpeg.stdin.write(frame)
 
+    def pipe_fd(self):
+        process = self._ffmpeg
+        if process is None:
+            return None
+        process.stdin.flush()
+        return process.stdin.fileno()
+
     def close(self):
-        if self._ffmpeg is not None:
+        if self._ffmpeg is not None and self._ffmpeg.stdin is not None:
             self._ffmpeg.stdin.close()
@@ -0,0 +1,121 @@
+from multiprocessing import resource_tracker, shared_memory
+import logging
+import multiprocessing
+
+import numpy as np
+
+_logger = logging.getLogger(__name__)
+
+# Header layout, in uint64 words: next sequence number, closed flag, and the
+# sequence number stored in each slot (0 while the slot is being written)
+_SEQ = 0
+_CLOSED = 1
+_SLOTS = 2
+
+
+class FrameRing:
+    # Single producer, single consumer ring of fixed size frames living in
+    # shared memory, so frames can be handed to another process without
+    # pickling them. The producer never blocks: when the consumer falls behind
+    # the oldest frames are overwritten and skipped.
+    def __init__(self, shape, slots=8, polled=False, name=None):
+        # A polled ring is read with latest() by a process that attaches to
+        # it by name, instead of being iterated by a child process
+        self._shape = tuple(shape)
+        self._slots = slots
+        header_size = (_SLOTS + slots) * 8
+        frame_size = int(np.prod(self._shape))
+        if name is None:
+            self._shm = shared_memory.SharedMemory(
+                create=True, size=header_size + slots * frame_size)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            # The creator is responsible for unlinking it
+            resource_tracker.unregister(self._shm._name, 'shared_memory')
+        self._header = np.ndarray(
+            (_SLOTS + slots,), np.uint64, buffer=self._shm.buf)
+        if name is None:
+            self._header[:] = 0
+        self._frames = np.ndarray(
+            (slots,) + self._shape, np.uint8, buffer=self._shm.buf,
+            offset=header_size)
+        self._available = None if polled else multiprocessing.Semaphore(0)
+        self._skipped = 0
+
+    @classmethod
+    def attach(cls, name, shape, slots):
+        return cls(shape, slots, polled=True, name=name)
+
+    def name(self):
+        return self._shm.name
+
+    def shape(self):
+        return self._shape
+
+    def slots(self):
+        return self._slots
+
+    def closed(self) -> bool:
+        return bool(self._header[_CLOSED])
+
+    def latest(self, out) -> int:
+        # Copies the newest frame into out and returns its sequence number,
+        # or 0 if there is none or it was overwritten while being copied
+        seq = int(self._header[_SEQ])
+        if seq == 0:
+            return 0
+        slot = (seq - 1) % self._slots
+        out[...] = self._frames[slot]
+        return seq if self._header[_SLOTS + slot] == seq else 0
+
+    def publish(self, frame) -> None:
+        seq = int(self._header[_SEQ])
+        slot = seq % self._slots
+        self._header[_SLOTS + slot] = 0
+        self._frames[slot] = frame
+        self._header[_SLOTS + slot] = seq + 1
+        self._header[_SEQ] = seq + 1
+        if self._available is not None:
+            self._available.release()
+
+    def close(self) -> None:
+        self._header[_CLOSED] = 1
+        if self._available is not None:
+            self._available.release()
+
+    def __iter__(self):
+        # Yields views into shared memory; a frame is valid until the next one
+        # is requested, as long as the producer has not lapped the ring
+        parent = multiprocessing.parent_process()
+        next_seq = 0
+        while True:
+            if not self._available.acquire(timeout=1):
+                if parent is not None and not parent.is_alive():
+                    break
+                continue
+            last_seq = int(self._header[_SEQ])
+            if next_seq >= last_seq:
+                if self._header[_CLOSED]:
+                    break
+                continue
+            # Skip frames that have already been overwritten
+            if last_seq - next_seq > self._slots - 1:
+                self._skipped += last_seq - next_seq - (self._slots - 1)
+                _logger.debug('motion detection behind, %d frames skipped',
+                              self._skipped)
+                next_seq = last_seq - (self._slots - 1)
+            while next_seq < last_seq:
+                slot = next_seq % self._slots
+                if self._header[_SLOTS + slot] == next_seq + 1:
+                    yield self._frames[slot]
+                next_seq += 1
+        _logger.debug('frame ring closed')
+
+    def detach(self) -> None:
+        del self._header
+        del self._frames
+        self._shm.close()
+
+    def unlink(self) -> None:
+        self.detach()
+        self._shm.unlink()
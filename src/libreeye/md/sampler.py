@@ -0,0 +1,40 @@
+import logging
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+class AdaptiveSampler:
+    # Decides which of the frames decoded at max_rate are analyzed. Right
+    # after motion every frame is, and then the interval between analyzed
+    # frames doubles every decay seconds until it reaches 1 / min_rate. The
+    # decoder keeps running at max_rate, so changing the rate is immediate.
+    def __init__(self, state, min_rate, max_rate, decay):
+        self._state = state
+        self._min_interval = 1 / min_rate
+        self._max_interval = 1 / max_rate
+        self._decay = decay
+        self._last_sample = 0
+        self._interval = self._min_interval
+
+    def interval(self, now) -> float:
+        idle = now - self._state.last_motion()
+        if idle <= 0:
+            return self._max_interval
+        # Limit the exponent, it can be huge before the first motion
+        steps = min(idle / self._decay, 64)
+        return min(self._max_interval * 2 ** steps, self._min_interval)
+
+    def take(self) -> bool:
+        now = time.time()
+        interval = self.interval(now)
+        if interval != self._interval and (
+                interval == self._max_interval or
+                interval == self._min_interval):
+            _logger.debug('sampling motion at %.2f fps', 1 / interval)
+        self._interval = interval
+        # Tolerate some jitter in the frame arrival times
+        if now - self._last_sample < interval * 0.9:
+            return False
+        self._last_sample = now
+        return True
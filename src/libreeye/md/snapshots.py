@@ -0,0 +1,69 @@
+import concurrent.futures
+import logging
+import queue
+
+import cv2
+import numpy as np
+
+from libreeye.md.algorithms.detector import draw_boxes
+
+_logger = logging.getLogger(__name__)
+
+
+class SnapshotWriter:
+    # Encodes pictures of motion frames as JPEG and writes them in a pool of
+    # threads, which run in parallel with detection as OpenCV releases the
+    # GIL. Frames are copied, scaled down to width if given, into one of
+    # max_pending buffers that are reused; write() waits for a free one, so
+    # memory does not grow with the number of pictures.
+    def __init__(self, quality=90, width=None, workers=2, max_pending=4):
+        self._params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        self._width = width
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            workers, thread_name_prefix='snapshot')
+        self._free = queue.Queue()
+        for _ in range(max_pending):
+            self._free.put(None)
+
+    def _size(self, frame):
+        height, width = frame.shape[:2]
+        if self._width is None or self._width >= width:
+            return width, height
+        return self._width, max(round(height * self._width / width), 1)
+
+    def write(self, path, frame, boxes=None) -> None:
+        size = self._size(frame)
+        shape = (size[1], size[0]) + frame.shape[2:]
+        buffer = self._free.get()
+        try:
+            if buffer is None or buffer.shape != shape:
+                buffer = np.empty(shape, np.uint8)
+            if size == (frame.shape[1], frame.shape[0]):
+                np.copyto(buffer, frame)
+            else:
+                cv2.resize(frame, size, dst=buffer,
+                           interpolation=cv2.INTER_AREA)
+            if boxes is not None and len(boxes) > 0:
+                scale = [size[0] / frame.shape[1], size[1] / frame.shape[0]]
+                draw_boxes(buffer,
+                           np.round(boxes * (scale * 2)).astype(np.int32))
+            self._executor.submit(self._encode, path, buffer)
+        except Exception:
+            # The slot would be lost otherwise, and write() would end up
+            # waiting forever
+            self._free.put(buffer)
+            raise
+
+    def _encode(self, path, buffer):
+        try:
+            _logger.debug('Writting image %s', path)
+            if not cv2.imwrite(path, buffer, self._params):
+                _logger.warning('could not write image %s', path)
+        except Exception:
+            _logger.exception('could not write image %s', path)
+        finally:
+            self._free.put(buffer)
+
+    def close(self) -> None:
+        # Waits for the pictures still being written
+        self._executor.shutdown(wait=True)
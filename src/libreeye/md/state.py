@@ -0,0 +1,19 @@
+import multiprocessing
+import time
+
+
+class MotionState:
+    # Time of the last detected motion, shared between the motion detection
+    # process and the camera process
+    def __init__(self):
+        self._last_motion = multiprocessing.Value('d', 0.0)
+
+    def notify(self) -> None:
+        self._last_motion.value = time.time()
+
+    def last_motion(self) -> float:
+        return self._last_motion.value
+
+    def active(self, hold) -> bool:
+        # Whether there has been motion in the last hold seconds
+        return time.time() - self._last_motion.value <= hold
@@ -0,0 +1,68 @@
+import cv2
+import numpy as np
+
+
+class Zone:
+    def __init__(self, name, mask, min_area):
+        self._name = name
+        self._mask = mask
+        self._min_area = min_area
+        ys, xs = np.nonzero(mask)
+        # Bounding box of the zone, as slices
+        self._box = (slice(ys.min(), ys.max() + 1),
+                     slice(xs.min(), xs.max() + 1))
+
+    def name(self):
+        return self._name
+
+    def mask(self):
+        return self._mask
+
+    def min_area(self):
+        return self._min_area
+
+    def box(self):
+        return self._box
+
+
+class Zones:
+    # The polygon zones of a camera rasterized once at the analysis
+    # resolution: a mask per zone, and an image with the threshold of every
+    # pixel, 255 outside the zones so that they never change. Overlapping
+    # zones use the lowest threshold.
+    def __init__(self, zone_configs, shape):
+        height, width = shape
+        self._deltas = np.full(shape, 255, np.uint8)
+        self._zones = []
+        for z in zone_configs:
+            points = np.array([
+                (round(x * (width - 1)), round(y * (height - 1)))
+                for x, y in z.polygon()
+            ], np.int32)
+            mask = np.zeros(shape, np.uint8)
+            cv2.fillPoly(mask, [points], 1)
+            if not mask.any():
+                continue
+            mask = mask.view(bool)
+            delta = min(max(int(z.threshold()), 0), 255)
+            np.minimum(self._deltas, delta, out=self._deltas, where=mask)
+            self._zones.append(Zone(z.name(), mask, z.min_area()))
+
+    def deltas(self):
+        return self._deltas
+
+    def zones(self):
+        return self._zones
+
+    def crop(self, margin):
+        # Smallest region holding every zone plus margin pixels around them,
+        # as slices
+        height, width = self._deltas.shape
+        if len(self._zones) == 0:
+            return slice(0, 0), slice(0, 0)
+        y0 = min(z.box()[0].start for z in self._zones)
+        y1 = max(z.box()[0].stop for z in self._zones)
+        x0 = min(z.box()[1].start for z in self._zones)
+        x1 = max(z.box()[1].stop for z in self._zones)
+        return (slice(max(y0 - margin, 0), min(y1 + margin, height)),
+                slice(max(x0 - margin, 0), min(x1 + margin, width)))
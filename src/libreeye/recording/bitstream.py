@@ -0,0 +1,177 @@
+# This file is part of Libreeye.
+# Copyright (C) 2019 by Christian Ponte
+#
+# Libreeye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Libreeye is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Libreeye. If not, see <http://www.gnu.org/licenses/>.
+
+from typing import List, NamedTuple
+
+_start_code = b'\x00\x00\x01'
+
+
+def _h264_nal(header):
+    # header holds the NAL unit header and the first byte of its payload.
+    # Returns (is a slice, is a keyframe, starts an access unit); a slice
+    # starts a new picture when first_mb_in_slice, an ue(v), is 0.
+    nal_type = header[0] & 0x1f
+    if 1 <= nal_type <= 5:
+        return True, nal_type == 5, bool(header[1] & 0x80)
+    # SEI, SPS, PPS, AUD and the NAL units reserved to precede a picture
+    return False, False, nal_type in (6, 7, 8, 9, 14, 15, 16, 17, 18)
+
+
+def _hevc_nal(header):
+    # Same as above, with first_slice_segment_in_pic_flag after the 2 byte
+    # header. IRAP pictures are keyframes.
+    nal_type = (header[0] >> 1) & 0x3f
+    if nal_type < 32:
+        return True, 16 <= nal_type <= 23, bool(header[2] & 0x80)
+    # VPS, SPS, PPS, AUD, prefix SEI and reserved prefix NAL units
+    return False, False, (nal_type in (32, 33, 34, 35, 39, 41, 42, 43, 44) or
+                          48 <= nal_type <= 55)
+
+
+# Parser and bytes needed after the start code to classify a NAL unit
+_nal_parsers = {
+    'h264': (_h264_nal, 2),
+    'hevc': (_hevc_nal, 3)
+}
+supported_codecs = tuple(_nal_parsers)
+
+
+class AccessUnit(NamedTuple):
+    data: memoryview
+    keyframe: bool
+
+
+class AccessUnitParser:
+    # Splits an Annex-B byte stream, fed in chunks of any size, into access
+    # units tagged as keyframes or not, without decoding them. Units that lie
+    # within a single chunk are returned as memoryview slices of it; only
+    # those split across chunks are copied. Streams of other codecs can be
+    # cut anywhere, so every chunk is returned as a keyframe unit.
+    def __init__(self, codec):
+        self._nal, header_size = _nal_parsers.get(codec, (None, 0))
+        self._nal_size = len(_start_code) + header_size
+        # Last bytes of the stream, where a start code may still be incomplete
+        self._tail = b''
+        # Chunks holding the current access unit, as (offset, chunk)
+        self._chunks = []
+        # Stream offset of the end of the data fed so far
+        self._end = 0
+        # Current access unit: start offset, and whether it already holds a
+        # picture and whether that picture is a keyframe
+        self._start = 0
+        self._picture = False
+        self._keyframe = False
+
+    def _slice(self, begin, end):
+        # Returns stream bytes [begin, end), copying only if they span chunks
+        for offset, chunk in self._chunks:
+            if offset <= begin and end <= offset + len(chunk):
+                return memoryview(chunk)[begin - offset:end - offset]
+        return memoryview(b''.join(
+            memoryview(chunk)[max(begin - offset, 0):end - offset]
+            for offset, chunk in self._chunks
+            if offset < end and begin < offset + len(chunk)
+        ))
+
+    def _unit(self, pos, header, units):
+        # Handles the NAL unit found at stream offset pos
+        vcl, keyframe, first = self._nal(header)
+        if first and self._picture:
+            units.append(AccessUnit(self._slice(self._start, pos),
+                                    self._keyframe))
+            self._start = pos
+            self._picture = False
+            self._keyframe = False
+        if vcl:
+            self._picture = True
+            self._keyframe = self._keyframe or keyframe
+
+    def feed(self, chunk) -> List[AccessUnit]:
+        if self._nal is None:
+            return [AccessUnit(memoryview(chunk), True)]
+        # bytes.find needs a bytes-like object, not a view
+        data = chunk if isinstance(chunk, bytes) else bytes(chunk)
+        offset = self._end
+        self._end += len(data)
+        self._chunks.append((offset, data))
+        units = []
+        size = self._nal_size
+        # Start codes beginning in the tail of the previous chunk, which were
+        # left for later because their header was not complete
+        window = self._tail + data[:size - 1]
+        base = offset - len(self._tail)
+        pos = window.find(_start_code, max(len(self._tail) - size + 1, 0))
+        while pos != -1 and pos < len(self._tail) and \
+                pos + size <= len(window):
+            # Include the leading zero of 4-byte start codes
+            start = pos - 1 if pos > 0 and window[pos - 1] == 0 else pos
+            self._unit(base + start, window[pos + 3:pos + size], units)
+            pos = window.find(_start_code, pos + 3)
+        # Start codes in this chunk with their header fully available
+        pos = data.find(_start_code)
+        while pos != -1 and pos + size <= len(data):
+            if pos > 0:
+                start = pos - 1 if data[pos - 1] == 0 else pos
+            else:
+                start = -1 if self._tail[-1:] == b'\0' else 0
+            self._unit(offset + start, data[pos + 3:pos + size], units)
+            pos = data.find(_start_code, pos + 3)
+        # One byte more than a start code and header, to look behind them
+        self._tail = (self._tail + data[-size:])[-size:]
+        # Forget the chunks before the current access unit
+        while self._chunks[0][0] + len(self._chunks[0][1]) <= self._start \
+                and len(self._chunks) > 1:
+            self._chunks.pop(0)
+        return units
+
+    def flush(self) -> List[AccessUnit]:
+        # Returns the last access unit, once the stream has ended
+        if self._nal is None or self._start == self._end:
+            return []
+        unit = AccessUnit(self._slice(self._start, self._end), self._keyframe)
+        self._start = self._end
+        self._chunks.clear()
+        self._picture = False
+        self._keyframe = False
+        return [unit]
+
+
+class KeyframeFilter:
+    # Reduces a stream to its keyframes. When full() is requested the whole
+    # stream is let through again, starting at the next keyframe so that the
+    # decoder never references a dropped frame.
+    def __init__(self, codec):
+        self._parser = AccessUnitParser(codec)
+        self._full = False
+        self._passing = False
+
+    def is_full(self) -> bool:
+        return self._full
+
+    def full(self, enable) -> None:
+        self._full = enable
+        if not enable:
+            self._passing = False
+
+    def feed(self, chunk) -> bytes:
+        out = []
+        for unit in self._parser.feed(chunk):
+            if unit.keyframe:
+                self._passing = self._full
+                out.append(unit.data)
+            elif self._passing:
+                out.append(unit.data)
+        return b''.join(out)
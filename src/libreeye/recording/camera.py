@@ -20,6 +20,7 @@
 # - Program blocks when camera start with wait returns any error while being
 #   reachable
 
+from contextlib import nullcontext
 from typing import List
 import errno
 import fcntl
@@ -27,6 +28,8 @@ import logging
 import multiprocessing
 import os
 import queue
+import re
+import selectors
 import signal
 import subprocess
 import sys
@@ -36,19 +39,84 @@ import time
 import ffmpeg
 
 from libreeye.md.iterator import FrameIterator
-from libreeye.md.algorithms.basic import MotionDetection
+from libreeye.md.algorithms.motion import MotionDetection
+from libreeye.md.algorithms.vectors import VectorIterator, \
+    VectorMotionDetection
+from libreeye.md.events import EventLog
+from libreeye.md.ring import FrameRing
+from libreeye.md.sampler import AdaptiveSampler
+from libreeye.md.state import MotionState
+from libreeye.recording import splice
+from libreeye.recording.preroll import PreRollGate
+from libreeye.recording.probe import same_stream
+from libreeye.recording.queued_writer import QueuedWriter
 
 _logger = logging.getLogger(__name__)
+_stats_interval = 60
+
+
+def _tee_escape(value):
+    return re.sub(r'([\\\[\]|:])', r'\\\1', str(value))
+
+
+def _tee_slave(url, options):
+    # The tee muxer unescapes each slave, and then its options once more
+    opts = ':'.join(f'{k}={_tee_escape(_tee_escape(v))}'
+                    for k, v in options.items())
+    return f'[{opts}]{_tee_escape(url)}'
+
+
+class _ErrorQueue(queue.Queue):
+    # Queue that also wakes up the camera read loop whenever an error is put,
+    # so that the loop can sleep on the selector instead of polling the queue
+    def __init__(self):
+        super().__init__()
+        self._wakeup_fd = None
+
+    def set_wakeup_fd(self, fd):
+        self._wakeup_fd = fd
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        if self._wakeup_fd is not None:
+            try:
+                os.write(self._wakeup_fd, b'\0')
+            except BlockingIOError:
+                # Pipe is full, the read loop will be woken up anyway
+                pass
+
+
+class _StreamChanged(RuntimeError):
+    # Put in the error queue when the cached probe turns out to be stale, so
+    # that recording starts over with the fresh one
+    def __init__(self, probe):
+        super().__init__('Camera stream changed since it was last probed')
+        self.probe = probe
 
 
 class Camera:
-    def __init__(self, name, config, storage_list):
+    def __init__(self, name, config, storage_list, probe_cache=None,
+                 motion_engine=None):
         self._name = name
         self._config = config
         self._storage_list = storage_list
+        self._probe_cache = probe_cache
+        self._motion_engine = motion_engine
         self._active = False
         self._process = None
-        self._error_queue = queue.Queue()
+        self._started = None
+        self._startup = None
+        self._streaming = False
+        # Monotonic time at which the camera process got its startup slot
+        self._connect_time = None
+        self._refresh = None
+        self._error_queue = _ErrorQueue()
+        self._wakeup_r = None
+        self._wakeup_w = None
+        self._splice = False
+        self._motion_state = None
+        self._gate = None
+        self._events = None
 
     def _configure_logger(self):
         log_file = self._config.logfile()
@@ -64,11 +132,12 @@ class Camera:
         sys.stdout = logging.root.handlers[0].stream
         sys.stderr = logging.root.handlers[0].stream
 
-    def _create_ffmpeg(self) -> subprocess.Popen:
+    def _create_ffmpeg(self, outputs, pipe) -> subprocess.Popen:
         _logger.debug('_create_ffmpeg called')
         input_config = self._config.input()
         ffmpeg_pipe = ffmpeg.input(
-            input_config.url(), v='warning', **input_config.ffmpeg_options())
+            input_config.url(), v='warning', **input_config.ffmpeg_options()
+        ).video
         # If a resolution is specified, rescale the image
         if input_config.resolution():
             ffmpeg_pipe = ffmpeg_pipe.filter(
@@ -87,17 +156,37 @@ class Camera:
         #     shadowx=1,
         #     shadowy=1
         # )
-        # Create an output pipe from which bytes can be read
-        ffmpeg_pipe = ffmpeg_pipe.output(
-            'pipe:',
-            format='rawvideo',
-            vcodec='copy',
-            threads=1
-        )
-        p = ffmpeg_pipe.run_async(
-            pipe_stdin=True,
-            pipe_stdout=True
+        if len(outputs) == 0:
+            # Create an output pipe from which bytes can be read
+            ffmpeg_pipe = ffmpeg_pipe.output(
+                'pipe:',
+                format='rawvideo',
+                vcodec='copy',
+                threads=1
+            )
+        else:
+            # Let ffmpeg write every output by itself, plus the output pipe
+            # only if some storage or motion detection still need the bytes
+            for o in outputs:
+                o.open()
+            slaves = [_tee_slave(o.url(), o.options()) for o in outputs]
+            if pipe:
+                slaves.append(_tee_slave('pipe:1', {'f': 'rawvideo'}))
+            ffmpeg_pipe = ffmpeg_pipe.output(
+                '|'.join(slaves),
+                format='tee',
+                vcodec='copy',
+                use_fifo=1,
+                threads=1
+            )
+        p = subprocess.Popen(
+            ffmpeg_pipe.compile(),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            pass_fds=[fd for o in outputs for fd in o.pass_fds()]
         )
+        for o in outputs:
+            o.started()
         flag = fcntl.fcntl(p.stdout.fileno(), fcntl.F_GETFD)
         fcntl.fcntl(p.stdout.fileno(), fcntl.F_SETFL, flag | os.O_NONBLOCK)
         return p
@@ -107,6 +196,11 @@ class Camera:
         process.communicate(b'q')
         _logger.debug('ffmpeg subprocess terminated')
 
+    def _ffmpeg_exited(self, outputs):
+        # The segments written by the outputs have all been reported
+        for o in outputs:
+            o.stopped()
+
     def _ffmpeg_probe(self):
         _logger.debug('_ffmpeg_probe called')
         input_config = self._config.input()
@@ -123,103 +217,442 @@ class Camera:
             _logger.error(e.stderr.decode())
             raise RuntimeError('Error while ffprobing camera') from e
 
-    def _create_motion_thread(self, probe):
+    def _probe(self):
+        # Returns the cached probe if there is one, so that recording starts
+        # without opening an extra RTSP session; it is refreshed afterwards
+        if self._probe_cache is None:
+            return self._ffmpeg_probe(), False
+        input_config = self._config.input()
+        probe = self._probe_cache.get(input_config.url(),
+                                      input_config.ffmpeg_options())
+        if probe is not None:
+            _logger.debug('using cached probe')
+            return probe, True
+        probe = self._ffmpeg_probe()
+        self._probe_cache.put(input_config.url(),
+                              input_config.ffmpeg_options(), probe)
+        return probe, False
+
+    def _refresh_probe(self, cached):
+        _logger.debug('_refresh_probe called')
+        input_config = self._config.input()
+        try:
+            probe = self._ffmpeg_probe()
+        except RuntimeError as e:
+            _logger.warning('could not refresh probe: %s', e)
+            return
+        self._probe_cache.put(input_config.url(),
+                              input_config.ffmpeg_options(), probe)
+        # Writers and motion detection were set up with the cached attributes
+        if not same_stream(cached, probe):
+            self._error_queue.put(_StreamChanged(probe))
+
+    def _feed_ring(self, frame_iter, ring, sampler):
+        for frame in frame_iter:
+            if sampler is None or sampler.take():
+                ring.publish(frame)
+        ring.close()
+
+    def _run_motion(self, motion):
+        # This process finishes once the frame ring is closed, and is only
+        # terminated if the camera process exits abruptly
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        _logger.debug('motion process started')
+        motion.run()
+        _logger.debug('motion process finished')
+
+    def _create_motion_process(self, probe):
+        # Frames are decoded by a thread of the camera process and handed to
+        # the motion detection process through a shared memory ring, so that
+        # detection never competes with recording for the GIL
         motion_config = self._config.motion()
         num, denom = [int(n) for n in probe['r_frame_rate'].split('/')]
+        if motion_config.algorithm() == 'vectors':
+            return self._create_vector_process(probe, num / denom)
         frame_iter = FrameIterator(
             probe['codec_name'],
             probe['width'],
             probe['height'],
             num // denom,
-            motion_config.resolution_scale()
+            motion_config.resolution_scale(),
+            motion_config.decode() == 'keyframes',
+            motion_config.max_rate()
         )
-        motion = MotionDetection(motion_config, frame_iter,
-                                 motion_config.logfile())
-        thread = threading.Thread(target=motion.run)
+        # Lower the rate of analyzed frames while there is no motion
+        sampler = None
+        if motion_config.min_rate() < motion_config.max_rate():
+            sampler = AdaptiveSampler(
+                self._motion_state,
+                motion_config.min_rate(),
+                motion_config.max_rate(),
+                motion_config.rate_decay()
+            )
+        # With a shared motion engine, it polls the ring instead
+        process = None
+        if self._motion_engine is not None:
+            ring = FrameRing(frame_iter.shape(), polled=True)
+            self._motion_engine.register(self._name, ring)
+        else:
+            ring = FrameRing(frame_iter.shape())
+            motion = MotionDetection(motion_config, ring, self._name,
+                                     self._motion_state)
+            process = multiprocessing.Process(
+                target=self._run_motion, args=(motion,),
+                name=f'{self._name}-motion', daemon=True)
+            process.start()
+        thread = threading.Thread(
+            target=self._feed_ring, args=(frame_iter, ring, sampler))
         thread.start()
-        return frame_iter, thread
+        return frame_iter, ring, thread, process
+
+    def _create_vector_process(self, probe, framerate):
+        # The compressed stream itself is piped to the motion detection
+        # process, which decodes it there
+        motion_config = self._config.motion()
+        vector_iter = VectorIterator(probe['codec_name'])
+        motion = VectorMotionDetection(motion_config, vector_iter, framerate,
+                                       self._name, self._motion_state)
+        process = multiprocessing.Process(
+            target=self._run_motion, args=(motion,),
+            name=f'{self._name}-motion', daemon=True)
+        process.start()
+        vector_iter.started()
+        return vector_iter, None, None, process
 
     def _interrupt(self, signum, _):
         _logger.debug('_interrupt called')
         self._active = False
+        self._wakeup()
 
-    def start(self, wait=False):
-        _logger.debug('start called with wait=%s', wait)
-        c = threading.Condition()
+    def _create_wakeup_pipe(self):
+        # The read loop sleeps until either the ffmpeg pipe or this pipe are
+        # readable; errors and signals write a byte into it to wake the loop
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._error_queue.set_wakeup_fd(self._wakeup_w)
+
+    def _wakeup(self):
+        if self._wakeup_w is None:
+            return
+        try:
+            os.write(self._wakeup_w, b'\0')
+        except BlockingIOError:
+            pass
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
 
-        def _handler(signum, _):
-            with c:
-                c.notify_all()
+    def _wait(self, timeout):
+        # Sleep for timeout seconds unless woken up by an error or a signal
+        with selectors.DefaultSelector() as sel:
+            sel.register(self._wakeup_r, selectors.EVENT_READ)
+            sel.select(timeout)
+        self._drain_wakeup()
+
+    def _check_errors(self):
+        # Writers and the frame iterator are closed as the error leaves
+        # _record
+        try:
+            err = self._error_queue.get(block=False)
+        except queue.Empty:
+            return
+        raise err
+
+    def _segment_closed(self, path, start, end):
+        _logger.info('segment %s closed, %.0f seconds recorded', path,
+                     end - start)
+        # Motion events are linked to the segments that cover them
+        if self._events is not None:
+            self._events.segment(path, start, end)
+
+    def _create_outputs(self, probe):
+        # Returns the outputs written by the ffmpeg process itself and the
+        # writers fed by the read loop
+        output_config = self._config.output()
+        outputs = []
+        writers = []
+        for s in self._storage_list:
+            # Motion triggered recording needs the stream to go through the
+            # pre-roll gate
+            if output_config.fan_out() == 'tee' and self._gate is None:
+                o = s.create_output(self._name, self._config, probe,
+                                    self._segment_closed)
+                if o is not None:
+                    outputs.append(o)
+                    continue
+            w = s.create_writer(self._name, self._config, probe,
+                                self._error_queue, self._segment_closed,
+                                self._motion_state)
+            # Kernel pipes already act as bounded queues when splicing
+            if self._splice:
+                writers.append(w)
+                continue
+            writers.append(QueuedWriter(
+                type(w).__name__,
+                w,
+                output_config.queue_size(),
+                output_config.overflow_policy(),
+                probe['codec_name'],
+                self._error_queue
+            ))
+        return outputs, writers
+
+    def _log_stats(self, writers, frame_iter):
+        for w in writers + [frame_iter]:
+            if not isinstance(w, QueuedWriter):
+                continue
+            stats = w.stats()
+            level = logging.INFO if stats['dropped_chunks'] else logging.DEBUG
+            _logger.log(level, '%s queue: %s', w.name(), stats)
+
+    def _pipe_fds(self, writers, frame_iter):
+        # Returns None when some consumer needs the frames in userspace
+        consumers = list(writers)
+        if frame_iter is not None:
+            consumers.append(frame_iter)
+        fds = [c.pipe_fd() for c in consumers]
+        return None if None in fds else fds
+
+    def _read_loop(self, process, writers, frame_iter):
+        _logger.debug('entering read loop')
+        next_stats = time.monotonic() + _stats_interval
+        forwarder = None
+        if self._splice:
+            forwarder = splice.Forwarder(
+                process.stdout.fileno(), self._config.output().pipe_size())
+        with selectors.DefaultSelector() as sel, forwarder or nullcontext():
+            sel.register(process.stdout, selectors.EVENT_READ)
+            sel.register(self._wakeup_r, selectors.EVENT_READ)
+            while self._active:
+                # Periodically report queue depth and drop counters
+                now = time.monotonic()
+                if now >= next_stats:
+                    self._log_stats(writers, frame_iter)
+                    next_stats = now + _stats_interval
+                # Sleep until there is data to read or an event to attend
+                for key, _ in sel.select(next_stats - now):
+                    if key.fileobj == self._wakeup_r:
+                        self._drain_wakeup()
+                        self._check_errors()
+                        continue
+                    # Move bytes pipe to pipe when every consumer allows it
+                    fds = None
+                    if forwarder is not None:
+                        fds = self._pipe_fds(writers, frame_iter)
+                    if fds is not None:
+                        if forwarder.forward(fds) == 0:
+                            _logger.debug('ffmpeg output closed')
+                            return
+                        self._stream_started()
+                        continue
+                    # Read everything available in the pipe
+                    frame = process.stdout.read()
+                    # Spurious wakeup, nothing to read
+                    if frame is None:
+                        continue
+                    # End of file, FFmpeg has stopped
+                    if len(frame) == 0:
+                        _logger.debug('ffmpeg output closed')
+                        return
+                    self._stream_started()
+                    chunks = (
+                        [frame] if self._gate is None
+                        else self._gate.feed(frame)
+                    )
+                    for c in chunks:
+                        for w in writers:
+                            w.write(c)
+                    if frame_iter is not None:
+                        frame_iter.write(frame)
+        _logger.debug('read loop exited')
+
+    def start(self, wait=False, startup=None):
+        # startup is an optional semaphore shared by the cameras being started
+        # at the same time, which limits how many of them connect at once
+        _logger.debug('start called with wait=%s', wait)
+        self._started = multiprocessing.Event()
+        self._startup = startup
+        self._connect_time = multiprocessing.Value('d', 0.0)
         self._process = multiprocessing.Process(target=self.run)
-        if wait:
-            signal.signal(signal.SIGUSR1, _handler)
         self._process.start()
         if wait:
-            with c:
-                c.wait()
-            _logger.debug('start wait completed')
+            self.wait_started()
+
+    def wait_started(self) -> bool:
+        # The time waiting for a startup slot does not count
+        timeout = self._config.input().timeout()
+        while not self._started.wait(1):
+            if not self._process.is_alive():
+                _logger.warning('camera %s exited while starting', self._name)
+                return False
+            connecting = self._connect_time.value
+            if connecting > 0 and time.monotonic() >= connecting + timeout:
+                _logger.warning('camera %s did not start within %d seconds',
+                                self._name, timeout)
+                return False
+        _logger.debug('start wait completed')
+        return True
 
     def run(self):
         self._configure_logger()
         _logger.debug('camera process started')
         # Finish setup
         self._active = True
+        self._create_wakeup_pipe()
         signal.signal(signal.SIGTERM, self._interrupt)
-        # Probe camera
-        probe = self._ffmpeg_probe()
-        # Open writers
-        writers = [
-            s.create_writer(self._name, self._config, probe, self._error_queue)
-            for s in self._storage_list
-        ]
-        # Start motion detection thread if enabled
-        frame_iter = None
-        motion_thread = None
+        output_config = self._config.output()
         if self._config.motion() is not None:
-            frame_iter, motion_thread = self._create_motion_thread(probe)
-        # Loop until finished
-        while self._active:
-            # Start FFmpeg input stream
-            process = self._create_ffmpeg()
-            # Notify parent process that camera has started
-            os.kill(multiprocessing.parent_process().pid, signal.SIGUSR1)
-            # Read loop
-            while self._active and process.poll() is None:
-                # Check for exceptions
+            # The batched engine only runs the basic algorithm
+            if (self._motion_engine is not None and
+                    self._config.motion().algorithm() != 'basic'):
+                self._motion_engine = None
+            self._motion_state = (
+                MotionState() if self._motion_engine is None
+                else self._motion_engine.state(self._name)
+            )
+        elif output_config.recording() == 'motion':
+            raise RuntimeError(
+                'Motion triggered recording requires a [motion] section')
+        if (output_config.recording() != 'motion' and
+                output_config.forwarding() == 'splice'):
+            self._splice = splice.available()
+            if not self._splice:
+                _logger.warning('splice is not available, copying instead')
+        # Wait for a free startup slot, held while probing and connecting
+        if self._startup is not None:
+            self._startup.acquire()
+        self._connect_time.value = time.monotonic()
+        try:
+            probe, cached = self._probe()
+            while True:
                 try:
-                    err = self._error_queue.get(block=False)
-                    # If there is an error, close writers and frame iterator
-                    for w in writers:
-                        w.close()
-                    frame_iter.close()
-                    # And raise error
-                    raise err
-                except queue.Empty:
-                    pass
-                # Read next frame
-                frame = process.stdout.read()
-                if frame is not None:
-                    for w in writers:
-                        w.write(frame)
-                    if frame_iter is not None:
-                        frame_iter.write(frame)
-                time.sleep(0.001)
-            # If inner loop exited because FFmpeg suddenly stopped, sleep for
-            # some time and re-enter loop
-            if self._active:
-                time.sleep(10)
-            # Else stop FFmpeg process and exit loop
-            else:
-                self._stop_ffmpeg(process)
-        # Close writers
-        for w in writers:
-            w.close()
-        # Wait for motion thread to finish
-        if motion_thread is not None:
-            frame_iter.close()
-            motion_thread.join()
+                    self._record(output_config, probe, cached)
+                    break
+                except _StreamChanged as e:
+                    # Writers and motion detection were set up with the
+                    # cached attributes, start them over with the new ones
+                    _logger.warning('%s, recording again', e)
+                    probe, cached = e.probe, False
+                    self._refresh.join()
+                    self._clear_errors()
+        finally:
+            self._release_startup()
         _logger.debug('run finished')
 
+    def _release_startup(self):
+        if self._startup is not None:
+            self._startup.release()
+            self._startup = None
+
+    def _stream_started(self):
+        # The first bytes of the stream have arrived, so the camera is
+        # connected: let the next one start
+        if self._streaming:
+            return
+        self._streaming = True
+        self._started.set()
+        self._release_startup()
+
+    def _clear_errors(self):
+        # Errors of the writers that were just closed
+        while True:
+            try:
+                self._error_queue.get(block=False)
+            except queue.Empty:
+                return
+
+    def _record(self, output_config, probe, cached):
+        frame_iter = None
+        feed_thread = None
+        motion_process = None
+        ring = None
+        outputs = []
+        writers = []
+        process = None
+        try:
+            # Start motion detection process if enabled, before any other
+            # thread is running, and feed it through its own queue as well
+            if self._config.motion() is not None:
+                motion_iter, ring, feed_thread, motion_process = \
+                    self._create_motion_process(probe)
+                frame_iter = motion_iter if self._splice else QueuedWriter(
+                    'motion',
+                    motion_iter,
+                    self._config.motion().queue_size(),
+                    self._config.motion().overflow_policy(),
+                    probe['codec_name'],
+                    self._error_queue
+                )
+            # Only record around motion events if requested
+            if output_config.recording() == 'motion':
+                self._gate = PreRollGate(
+                    self._motion_state,
+                    probe['codec_name'],
+                    output_config.pre_roll(),
+                    output_config.post_roll()
+                )
+            # Record segments in the event database, once the motion process
+            # has been forked
+            if self._config.motion() is not None:
+                self._events = EventLog(self._config.motion().events(),
+                                        self._name,
+                                        self._config.motion().event_gap())
+            # Open outputs and writers
+            outputs, writers = self._create_outputs(probe)
+            # Check the cached probe while already recording
+            if cached:
+                self._refresh = threading.Thread(
+                    target=self._refresh_probe, args=(probe,), daemon=True)
+                self._refresh.start()
+            # Loop until finished
+            while self._active:
+                # Start FFmpeg input stream
+                pipe = len(writers) > 0 or frame_iter is not None
+                process = self._create_ffmpeg(outputs, pipe)
+                # Without a pipe, ffmpeg writes every output by itself and
+                # the stream is never seen here, so the camera counts as
+                # started once ffmpeg runs
+                if not pipe:
+                    self._stream_started()
+                # Read loop
+                self._read_loop(process, writers, frame_iter)
+                # A camera that could not connect does not keep its slot
+                # while retrying
+                self._release_startup()
+                # If read loop exited because FFmpeg suddenly stopped, sleep
+                # for some time and re-enter loop
+                if self._active:
+                    process.wait()
+                    process = None
+                    self._ffmpeg_exited(outputs)
+                    self._wait(10)
+        finally:
+            # Also when an error is raised, so that neither ffmpeg nor the
+            # motion process and its shared memory are left behind
+            if process is not None:
+                self._stop_ffmpeg(process)
+                self._ffmpeg_exited(outputs)
+            # Close writers
+            for w in writers:
+                w.close()
+            if self._events is not None:
+                self._events.close()
+                self._events = None
+            # Wait for motion detection to finish
+            if frame_iter is not None:
+                frame_iter.close()
+            if feed_thread is not None:
+                feed_thread.join()
+            if motion_process is not None:
+                motion_process.join()
+            if ring is not None:
+                ring.unlink()
+
     def stop(self):
         self._process.terminate()
         self._process.join()
@@ -0,0 +1,103 @@
+# This file is part of Libreeye.
+# Copyright (C) 2019 by Christian Ponte
+#
+# Libreeye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Libreeye is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Libreeye. If not, see <http://www.gnu.org/licenses/>.
+
+from typing import List
+import collections
+import logging
+import time
+
+from libreeye.recording.bitstream import AccessUnitParser
+
+_logger = logging.getLogger(__name__)
+# Hard limit for cameras that send keyframes very rarely
+_max_bytes = 64 * 2**20
+
+
+class PreRollGate:
+    # Lets the stream through only around motion events. While idle, the last
+    # pre_roll seconds are kept in memory, starting at a keyframe, and are
+    # released when motion is detected; the stream then goes through until
+    # post_roll seconds have passed since the last motion.
+    def __init__(self, state, codec, pre_roll, post_roll):
+        self._state = state
+        self._parser = AccessUnitParser(codec)
+        self._pre_roll = pre_roll
+        self._post_roll = post_roll
+        # Entries are (arrival time, chunk, starts with a keyframe)
+        self._buffer = collections.deque()
+        self._bytes = 0
+        # Arrival times of the buffered keyframes
+        self._keyframes = collections.deque()
+        self._recording = False
+
+    def _append(self, now, chunk, keyframe):
+        if len(chunk) == 0:
+            return
+        # Nothing before the first keyframe can be decoded
+        if not keyframe and len(self._keyframes) == 0:
+            return
+        self._buffer.append((now, chunk, keyframe))
+        self._bytes += len(chunk)
+        if keyframe:
+            self._keyframes.append(now)
+
+    def _popleft(self):
+        _, chunk, keyframe = self._buffer.popleft()
+        self._bytes -= len(chunk)
+        if keyframe:
+            self._keyframes.popleft()
+
+    def _trim(self, now):
+        # Drop whole GOPs while the next one still covers the pre-roll
+        while len(self._keyframes) > 1:
+            if (self._keyframes[1] > now - self._pre_roll and
+                    self._bytes <= _max_bytes):
+                break
+            self._popleft()
+            while not self._buffer[0][2]:
+                self._popleft()
+        while self._bytes > _max_bytes and len(self._buffer) > 0:
+            self._popleft()
+            while len(self._buffer) > 0 and not self._buffer[0][2]:
+                self._popleft()
+
+    def _flush(self) -> List:
+        chunks = [c for _, c, _ in self._buffer]
+        self._buffer.clear()
+        self._bytes = 0
+        self._keyframes.clear()
+        return chunks
+
+    def feed(self, chunk) -> List:
+        # Returns the chunks that have to be written. The stream is always
+        # parsed, even while recording, so that the buffer starts on access
+        # unit boundaries when going idle again.
+        now = time.time()
+        units = self._parser.feed(chunk)
+        if self._state.active(self._post_roll):
+            if self._recording:
+                return [u.data for u in units]
+            _logger.debug('motion detected, releasing %d bytes of pre-roll',
+                          self._bytes)
+            self._recording = True
+            return self._flush() + [u.data for u in units]
+        if self._recording:
+            _logger.debug('post-roll finished')
+            self._recording = False
+        for u in units:
+            self._append(now, u.data, u.keyframe)
+        self._trim(now)
+        return []
@@ -0,0 +1,81 @@
+# This file is part of Libreeye.
+# Copyright (C) 2019 by Christian Ponte
+#
+# Libreeye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Libreeye is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Libreeye. If not, see <http://www.gnu.org/licenses/>.
+
+from typing import Any, Dict, Optional
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+
+_logger = logging.getLogger(__name__)
+
+# Stream attributes that writers and motion detection depend on
+stream_keys = ('codec_name', 'width', 'height', 'r_frame_rate')
+
+
+class ProbeCache:
+    # ffprobe results keyed by url and input options, shared by all camera
+    # processes and persisted across restarts
+    def __init__(self, path):
+        self._path = path
+        self._lock_path = f'{path}.lock'
+
+    @staticmethod
+    def _key(url, options):
+        data = json.dumps([url, sorted(options.items())])
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def _read(self) -> Dict[str, Any]:
+        try:
+            with open(self._path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            _logger.warning('ignoring corrupt probe cache %s', self._path)
+            return {}
+
+    def get(self, url, options) -> Optional[Dict[str, Any]]:
+        try:
+            entry = self._read().get(self._key(url, options))
+        except OSError as e:
+            _logger.warning('could not read probe cache: %s', e)
+            return None
+        return None if entry is None else entry['probe']
+
+    def put(self, url, options, probe) -> None:
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(self._lock_path, 'w') as lock:
+                # Other camera processes may be updating the cache as well
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                cache = self._read()
+                cache[self._key(url, options)] = {
+                    'probe': probe,
+                    'time': time.time()
+                }
+                tmp_path = f'{self._path}.{os.getpid()}'
+                with open(tmp_path, 'w') as f:
+                    json.dump(cache, f)
+                os.replace(tmp_path, self._path)
+        except OSError as e:
+            _logger.warning('could not update probe cache: %s', e)
+
+
+def same_stream(a, b) -> bool:
+    return all(a.get(k) == b.get(k) for k in stream_keys)
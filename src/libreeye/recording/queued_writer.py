@@ -0,0 +1,164 @@
+# This file is part of Libreeye.
+# Copyright (C) 2019 by Christian Ponte
+#
+# Libreeye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Libreeye is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Libreeye. If not, see <http://www.gnu.org/licenses/>.
+
+from typing import Dict
+import collections
+import logging
+import threading
+
+from libreeye.recording.bitstream import AccessUnitParser
+from libreeye.storage.base import Writer
+
+_logger = logging.getLogger(__name__)
+
+POLICY_BLOCK = 'block'
+POLICY_DROP_OLDEST = 'drop-oldest'
+POLICY_DROP_TO_KEYFRAME = 'drop-to-keyframe'
+policies = (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_DROP_TO_KEYFRAME)
+
+
+class ChunkQueue:
+    def __init__(self, max_bytes, policy, codec):
+        if policy not in policies:
+            raise ValueError(f'Unknown queue overflow policy {policy}')
+        self._max_bytes = max_bytes
+        self._policy = policy
+        # Dropping to a keyframe needs the stream split into access units
+        self._parser = None
+        if policy == POLICY_DROP_TO_KEYFRAME:
+            self._parser = AccessUnitParser(codec)
+        self._cond = threading.Condition()
+        self._chunks = collections.deque()
+        self._bytes = 0
+        self._closed = False
+        # Set while dropping data until the next keyframe
+        self._skipping = False
+        self._dropped_chunks = 0
+        self._dropped_bytes = 0
+
+    def _drop(self, size):
+        self._dropped_chunks += 1
+        self._dropped_bytes += size
+
+    def _fits(self, size):
+        # A single chunk bigger than the queue is accepted when it is empty
+        return self._bytes + size <= self._max_bytes or self._bytes == 0
+
+    def _put_unit(self, unit):
+        # Once something is dropped, skip until a keyframe that fits
+        if self._skipping or not self._fits(len(unit.data)):
+            if not unit.keyframe or not self._fits(len(unit.data)):
+                self._skipping = True
+                self._drop(len(unit.data))
+                return
+            self._skipping = False
+        self._chunks.append(unit.data)
+        self._bytes += len(unit.data)
+
+    def put(self, chunk) -> None:
+        # Only the producer thread uses the parser
+        units = None if self._parser is None else self._parser.feed(chunk)
+        with self._cond:
+            if self._closed:
+                return
+            if units is not None:
+                for u in units:
+                    self._put_unit(u)
+                self._cond.notify_all()
+                return
+            if self._policy == POLICY_DROP_OLDEST:
+                while not self._fits(len(chunk)):
+                    old = self._chunks.popleft()
+                    self._bytes -= len(old)
+                    self._drop(len(old))
+            else:
+                while not self._fits(len(chunk)) and not self._closed:
+                    self._cond.wait()
+            self._chunks.append(chunk)
+            self._bytes += len(chunk)
+            self._cond.notify_all()
+
+    def get(self):
+        # Returns the next chunk, or None once the queue is closed and empty
+        with self._cond:
+            while len(self._chunks) == 0 and not self._closed:
+                self._cond.wait()
+            if len(self._chunks) == 0:
+                return None
+            chunk = self._chunks.popleft()
+            self._bytes -= len(chunk)
+            self._cond.notify_all()
+            return chunk
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                'queued_chunks': len(self._chunks),
+                'queued_bytes': self._bytes,
+                'dropped_chunks': self._dropped_chunks,
+                'dropped_bytes': self._dropped_bytes
+            }
+
+
+class QueuedWriter(Writer):
+    # Decouples a writer from the camera read loop: frames are put into a
+    # bounded queue and written by a dedicated thread, so a slow writer can
+    # only stall itself
+    def __init__(self, name, writer, max_bytes, policy, codec, error_queue):
+        super().__init__()
+        self._name = name
+        self._writer = writer
+        self._error_queue = error_queue
+        self._queue = ChunkQueue(max_bytes, policy, codec)
+        self._thread = threading.Thread(
+            target=self._consume, name=f'{name}-writer')
+        self._thread.start()
+
+    def _consume(self):
+        _logger.debug('%s writer thread started', self._name)
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                break
+            try:
+                self._writer.write(chunk)
+            except Exception as e:  # pylint: disable=broad-except
+                _logger.error('%s writer failed: %s', self._name, e)
+                self._error_queue.put(e)
+                # Stop accepting frames so the read loop never blocks on us
+                self._queue.close()
+                break
+        _logger.debug('%s writer thread finished', self._name)
+
+    def name(self) -> str:
+        return self._name
+
+    def stats(self) -> Dict[str, int]:
+        return self._queue.stats()
+
+    def write(self, frame) -> None:
+        self._queue.put(frame)
+
+    def close(self) -> None:
+        self._queue.close()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._writer.close()
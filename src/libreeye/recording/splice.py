@@ -0,0 +1,141 @@
+# This file is part of Libreeye.
+# Copyright (C) 2019 by Christian Ponte
+#
+# Libreeye is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Libreeye is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Libreeye. If not, see <http://www.gnu.org/licenses/>.
+
+# Pipe to pipe forwarding with tee(2) and splice(2): data is duplicated and
+# moved between pipes inside the kernel, without copying it into userspace.
+
+from typing import List, Optional
+import array
+import ctypes
+import ctypes.util
+import fcntl
+import logging
+import os
+import sys
+import termios
+
+_logger = logging.getLogger(__name__)
+_F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+_F_GETPIPE_SZ = getattr(fcntl, 'F_GETPIPE_SZ', 1032)
+_chunk_size = 2**20
+
+_libc = None
+if sys.platform.startswith('linux'):
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _libc.tee.argtypes = [
+            ctypes.c_int, ctypes.c_int, ctypes.c_size_t, ctypes.c_uint]
+        _libc.tee.restype = ctypes.c_ssize_t
+        _libc.splice.argtypes = [
+            ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+            ctypes.c_size_t, ctypes.c_uint]
+        _libc.splice.restype = ctypes.c_ssize_t
+    except (OSError, AttributeError):
+        _libc = None
+
+
+def available() -> bool:
+    return _libc is not None
+
+
+def _check(ret):
+    if ret == -1:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return ret
+
+
+def _tee(fd_in, fd_out, length):
+    return _check(_libc.tee(fd_in, fd_out, length, 0))
+
+
+def _splice(fd_in, fd_out, length):
+    return _check(_libc.splice(fd_in, None, fd_out, None, length, 0))
+
+
+def _pending(fd):
+    buf = array.array('i', [0])
+    fcntl.ioctl(fd, termios.FIONREAD, buf)
+    return buf[0]
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while len(view) > 0:
+        view = view[os.write(fd, view):]
+
+
+def set_pipe_size(fd, size):
+    try:
+        if fcntl.fcntl(fd, _F_GETPIPE_SZ) < size:
+            fcntl.fcntl(fd, _F_SETPIPE_SZ, size)
+    except OSError as e:
+        # Sizes above /proc/sys/fs/pipe-max-size need CAP_SYS_RESOURCE
+        _logger.debug('could not resize pipe %d: %s', fd, e)
+
+
+class Forwarder:
+    def __init__(self, src_fd, pipe_size):
+        self._src = src_fd
+        self._pipe_size = pipe_size
+        self._null = os.open(os.devnull, os.O_WRONLY)
+        set_pipe_size(self._src, pipe_size)
+
+    def forward(self, fds: List[int]) -> Optional[int]:
+        # Forwards what is available in the source pipe to every fd. Returns
+        # the number of bytes forwarded, 0 on end of file or None if there was
+        # nothing to read. Writes block, so a destination whose pipe is full
+        # stalls every other one until it catches up.
+        # Writers may reopen their pipes at any time
+        for fd in fds:
+            set_pipe_size(fd, self._pipe_size)
+        length = min(_pending(self._src), _chunk_size)
+        if length == 0:
+            # Either end of file or a spurious wakeup
+            try:
+                data = os.read(self._src, _chunk_size)
+            except BlockingIOError:
+                return None
+            for fd in fds:
+                _write_all(fd, data)
+            return len(data)
+        # Duplicate the data into every destination; tee never consumes it,
+        # blocks while a destination pipe is full and may copy less than
+        # length when it only has some room left
+        teed = [_tee(self._src, fd, length) for fd in fds]
+        if all(n == length for n in teed):
+            # Consume the forwarded data without copying it
+            left = length
+            while left > 0:
+                left -= _splice(self._src, self._null, left)
+            return length
+        # Some destination is behind, complete it through userspace
+        data = bytearray()
+        while len(data) < length:
+            data += os.read(self._src, length - len(data))
+        for fd, n in zip(fds, teed):
+            if n < length:
+                _write_all(fd, memoryview(data)[n:])
+        return length
+
+    def close(self):
+        os.close(self._null)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
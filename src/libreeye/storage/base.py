@@ -15,7 +15,7 @@
 # along with Libreeye. If not, see <http://www.gnu.org/licenses/>.
 
 from abc import ABC, abstractmethod
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 
 
 class Writer(ABC):
@@ -27,6 +27,42 @@ class Writer(ABC):
     def close(self) -> None:
         pass
 
+    def pipe_fd(self) -> Optional[int]:
+        # Writers that only copy frames into a pipe may return its file
+        # descriptor, so that frames can be forwarded without going through
+        # write()
+        return None
+
+
+class Output:
+    # Output that the camera ffmpeg process can write by itself, e.g. as a tee
+    # muxer slave, without the stream going through libreeye
+    def __init__(self, url: str, options: Dict[str, Any]):
+        self._url = url
+        self._options = options
+
+    def url(self) -> str:
+        return self._url
+
+    def options(self) -> Dict[str, Any]:
+        return self._options
+
+    def open(self) -> None:
+        # Called before each ffmpeg process writing the output is created
+        pass
+
+    def pass_fds(self) -> Tuple[int, ...]:
+        # File descriptors that process must inherit
+        return ()
+
+    def started(self) -> None:
+        # Called once the process has been created
+        pass
+
+    def stopped(self) -> None:
+        # Called once the process has exited
+        pass
+
 
 class Item(ABC):
     @abstractmethod
@@ -44,5 +80,12 @@ class Storage(ABC):
         pass
 
     @abstractmethod
-    def create_writer(self, name, camera_config, probe, error_queue) -> Writer:
+    def create_writer(self, name, camera_config, probe, error_queue,
+                      segment_listener=None, motion_state=None) -> Writer:
         pass
+
+    def create_output(self, name, camera_config, probe,
+                      segment_listener=None) -> Optional[Output]:
+        # Storages that cannot be written directly by ffmpeg return None, and
+        # are fed through a writer instead
+        return None
@@ -19,11 +19,14 @@ from datetime import datetime, timedelta
 from typing import Dict
 import logging
 import os
+import subprocess
+import threading
 import time
 
 import ffmpeg
 
-from libreeye.storage.base import Storage, Item, Writer
+from libreeye.recording.bitstream import KeyframeFilter, supported_codecs
+from libreeye.storage.base import Storage, Item, Output, Writer
 from libreeye.utils.config import LocalStorageConfig
 
 
@@ -44,14 +47,111 @@ class LocalStorage(Storage):
                 if os.path.getmtime(fullpath) <= due_date:
                     yield LocalItem(fullpath)
 
-    def create_writer(self, name, camera_config, probe, error_queue):
-        return LocalWriter(
+    def create_writer(self, name, camera_config, probe, error_queue,
+                      segment_listener=None, motion_state=None):
+        output_config = camera_config.output()
+        idle_recording = output_config.local_idle_recording()
+        if idle_recording == 'keyframes' and motion_state is None:
+            _logger.warning('keyframe idle recording requires motion '
+                            'detection, recording the full stream')
+            idle_recording = 'full'
+        if (idle_recording == 'keyframes' and
+                probe['codec_name'] not in supported_codecs):
+            _logger.warning('keyframe idle recording is not supported for '
+                            '%s, recording the full stream',
+                            probe['codec_name'])
+            idle_recording = 'full'
+        writer = LocalWriter(
             os.path.join(self._path, name),
             self._config.segment_length(),
-            camera_config.output().local_ffmpeg_options(),
+            output_config.local_ffmpeg_options(),
             probe['codec_name'],
-            error_queue
+            error_queue,
+            self._config.segmenter(),
+            segment_listener
         )
+        if idle_recording == 'keyframes':
+            writer.record_keyframes_when_idle(
+                motion_state, output_config.local_idle_delay())
+        return writer
+
+    def create_output(self, name, camera_config, probe,
+                      segment_listener=None):
+        # The tee muxer can only copy the stream, so any other codec option
+        # requires a dedicated ffmpeg process
+        options = camera_config.output().local_ffmpeg_options()
+        if any(v != 'copy' for v in options.values()):
+            _logger.debug('local storage options %s require a writer', options)
+            return None
+        # Dropping frames while idle requires the stream in userspace
+        if camera_config.output().local_idle_recording() == 'keyframes':
+            return None
+        return LocalOutput(os.path.join(self._path, name),
+                           self._config.segment_length(), segment_listener)
+
+
+class LocalOutput(Output):
+    # Segments written by the tee muxer of the camera ffmpeg process. As with
+    # the 'ffmpeg' segmenter of LocalWriter, the segment muxer appends every
+    # closed segment to a list, read through a pipe opened for each process,
+    # and closed segments are reported to segment_listener(path, start, end).
+    def __init__(self, path, segment_length, segment_listener=None):
+        os.makedirs(path, mode=0o755, exist_ok=True)
+        super().__init__(
+            os.path.join(path, '%d_%m_%y_%H_%M.mkv'),
+            {
+                'f': 'segment',
+                'segment_format': 'matroska',
+                'segment_time': segment_length,
+                'segment_atclocktime': 1,
+                'reset_timestamps': 1,
+                'strftime': 1
+            }
+        )
+        self._path = path
+        self._segment_listener = segment_listener
+        self._segment_start = 0
+        self._list_r = None
+        self._list_w = None
+        self._list_thread = None
+
+    def options(self):
+        if self._list_w is None:
+            return self._options
+        return dict(self._options, segment_list=f'pipe:{self._list_w}',
+                    segment_list_type='flat')
+
+    def open(self):
+        if self._segment_listener is not None:
+            self._list_r, self._list_w = os.pipe()
+
+    def pass_fds(self):
+        return () if self._list_w is None else (self._list_w,)
+
+    def started(self):
+        if self._list_w is None:
+            return
+        os.close(self._list_w)
+        self._list_w = None
+        self._segment_start = time.time()
+        self._list_thread = threading.Thread(
+            target=self._read_segment_list, args=(self._list_r,))
+        self._list_thread.start()
+
+    def _read_segment_list(self, list_r):
+        # Ends once the process exits and the pipe is closed
+        with open(list_r, 'r') as segment_list:
+            for line in segment_list:
+                end = time.time()
+                _logger.debug('segment %s closed', line.strip())
+                self._segment_listener(os.path.join(self._path, line.strip()),
+                                       self._segment_start, end)
+                self._segment_start = end
+
+    def stopped(self):
+        if self._list_thread is not None:
+            self._list_thread.join()
+            self._list_thread = None
 
 
 class LocalItem(Item):
@@ -67,8 +167,12 @@ class LocalItem(Item):
 
 
 class LocalWriter(Writer):
+    # With the 'libreeye' segmenter a new ffmpeg process is spawned for every
+    # segment; with 'ffmpeg' a single process with the segment muxer cuts the
+    # stream on keyframes at wall clock boundaries. Either way, closed segments
+    # are reported to segment_listener(path, start, end).
     def __init__(self, path, segment_length, ffmpeg_opts, ffmpeg_format,
-                 error_queue):
+                 error_queue, segmenter='libreeye', segment_listener=None):
         super().__init__()
         self._path = path
         os.makedirs(self._path, mode=0o755, exist_ok=True)
@@ -76,30 +180,101 @@ class LocalWriter(Writer):
         self._ffmpeg_opts = ffmpeg_opts
         self._ffmpeg_format = ffmpeg_format
         self._error_queue = error_queue
+        self._segmenter = segmenter
+        self._segment_listener = segment_listener
         self._ffmpeg = None
+        self._filename = None
         self._segment_start = 0
+        self._list_thread = None
+        self._input_opts = {}
+        self._motion_state = None
+        self._idle_delay = 0
+        self._keyframe_filter = None
+
+    def record_keyframes_when_idle(self, motion_state, idle_delay):
+        # Only keyframes are stored until motion is detected, and again once
+        # idle_delay seconds have passed without motion. Timestamps are taken
+        # from the wall clock so that the timeline stays continuous.
+        self._motion_state = motion_state
+        self._idle_delay = idle_delay
+        self._keyframe_filter = KeyframeFilter(self._ffmpeg_format)
+        self._input_opts = {'use_wallclock_as_timestamps': 1}
+
+    def _segment_closed(self, filename, end):
+        _logger.debug('segment %s closed', filename)
+        if self._segment_listener is not None:
+            self._segment_listener(filename, self._segment_start, end)
+        self._segment_start = end
 
     def _ffmpeg_open(self):
         _logger.debug('_ffmpeg_open called')
-        filename = os.path.join(
+        self._filename = os.path.join(
             self._path,
             f'{time.strftime("%d_%m_%y_%H_%M", time.localtime())}.mkv'
         )
         self._ffmpeg = (
             ffmpeg
-            .input('pipe:', f=self._ffmpeg_format, v='warning')
-            .output(filename, **self._ffmpeg_opts)
+            .input('pipe:', f=self._ffmpeg_format, v='warning',
+                   **self._input_opts)
+            .output(self._filename, **self._ffmpeg_opts)
             .overwrite_output()
             .run_async(pipe_stdin=True)
         )
 
+    def _read_segment_list(self, list_r):
+        # The segment muxer appends a line to its list every time a segment
+        # is closed
+        with open(list_r, 'r') as segment_list:
+            for line in segment_list:
+                filename = os.path.join(self._path, line.strip())
+                self._segment_closed(filename, time.time())
+
+    def _ffmpeg_open_segmenter(self):
+        _logger.debug('_ffmpeg_open_segmenter called')
+        list_r, list_w = os.pipe()
+        args = (
+            ffmpeg
+            .input('pipe:', f=self._ffmpeg_format, v='warning',
+                   **self._input_opts)
+            .output(
+                os.path.join(self._path, '%d_%m_%y_%H_%M.mkv'),
+                f='segment',
+                segment_format='matroska',
+                segment_time=self._segment_length,
+                segment_atclocktime=1,
+                segment_list=f'pipe:{list_w}',
+                segment_list_type='flat',
+                reset_timestamps=1,
+                strftime=1,
+                **self._ffmpeg_opts
+            )
+            .overwrite_output()
+            .compile()
+        )
+        self._ffmpeg = subprocess.Popen(
+            args, stdin=subprocess.PIPE, pass_fds=(list_w,))
+        os.close(list_w)
+        self._list_thread = threading.Thread(
+            target=self._read_segment_list, args=(list_r,))
+        self._list_thread.start()
+
     def _ffmpeg_close(self):
         _logger.debug('_ffmpeg_close called')
         self._ffmpeg.stdin.close()
         self._ffmpeg.wait()
         self._ffmpeg = None
+        if self._list_thread is not None:
+            self._list_thread.join()
+            self._list_thread = None
+        else:
+            self._segment_closed(self._filename, time.time())
 
-    def write(self, frame) -> None:
+    def _next_segment(self):
+        if self._segmenter == 'ffmpeg':
+            if self._ffmpeg is None:
+                self._ffmpeg_open_segmenter()
+                self._segment_start = time.time()
+            return
         if self._ffmpeg is None:
             self._ffmpeg_open()
             self._segment_start = time.time()
@@ -107,8 +282,31 @@ class LocalWriter(Writer):
             self._ffmpeg_close()
             self._ffmpeg_open()
             self._segment_start = time.time()
+
+    def _filter(self, frame):
+        full = self._motion_state.active(self._idle_delay)
+        if full != self._keyframe_filter.is_full():
+            _logger.debug('recording %s', 'full stream' if full else
+                          'keyframes only')
+            self._keyframe_filter.full(full)
+        return self._keyframe_filter.feed(frame)
+
+    def write(self, frame) -> None:
+        if self._keyframe_filter is not None:
+            frame = self._filter(frame)
+            if len(frame) == 0:
+                return
+        self._next_segment()
         self._ffmpeg.stdin.write(frame)
 
+    def pipe_fd(self):
+        # Keyframe filtering needs the frames in userspace
+        if self._keyframe_filter is not None:
+            return None
+        self._next_segment()
+        self._ffmpeg.stdin.flush()
+        return self._ffmpeg.stdin.fileno()
+
     def close(self):
         if self._ffmpeg is not None:
             self._ffmpeg_close()
@@ -111,7 +111,8 @@ class YoutubeStorage(Storage):
                 more_pages = False
         return expired
 
-    def create_writer(self, name, camera_config, probe, error_queue):
+    def create_writer(self, name, camera_config, probe, error_queue,
+                      segment_listener=None, motion_state=None):
         return YoutubeWriter(
             name,
             self._segment_length,
@@ -31,6 +31,19 @@ class Config:
     def daemon_logfile(self):
         return self._daemon.get('Log')
 
+    def daemon_start_parallelism(self):
+        return self._daemon.getint('StartParallelism', 8)
+
+    def daemon_probe_cache(self):
+        return self._daemon.get(
+            'ProbeCache', '/var/lib/libreeye/probe-cache.json')
+
+    def daemon_motion_engine(self):
+        return self._daemon.get('MotionEngine', 'per-camera')
+
+    def daemon_motion_interval(self):
+        return self._daemon.getfloat('MotionInterval', 1.0)
+
 
 class CameraConfig:
     def __init__(self, path):
@@ -48,12 +61,16 @@ class CameraConfig:
         if not config.has_section('output'):
             raise KeyError(f'\"output\" section missing in {path}')
         self._output = CameraOutputConfig(config['output'])
-        # Section: motion
-        self._motion = (
-            CameraMotionConfig(config['motion'])
-            if config.has_section('motion')
-            else None
-        )
+        # Section: motion, and its zones
+        self._motion = None
+        if config.has_section('motion'):
+            zones = [
+                MotionZoneConfig(section[len('zone:'):], config[section],
+                                 config['motion'])
+                for section in config.sections()
+                if section.startswith('zone:')
+            ]
+            self._motion = CameraMotionConfig(config['motion'], zones)
 
     def input(self):
         return self._input
@@ -108,6 +125,12 @@ class CameraOutputConfig:
         _logger.debug(options)
         return options
 
+    def local_idle_recording(self):
+        return self._output.get('LocalIdleRecording', 'full')
+
+    def local_idle_delay(self):
+        return self._output.getfloat('LocalIdleDelay', 30)
+
     def youtube_ffmpeg_options(self):
         if 'YoutubeFFmpegOptions' not in self._output:
             options = {}
@@ -117,14 +140,57 @@ class CameraOutputConfig:
         _logger.debug(options)
         return options
 
+    def recording(self):
+        return self._output.get('Recording', 'continuous')
+
+    def pre_roll(self):
+        return self._output.getfloat('PreRoll', 10)
+
+    def post_roll(self):
+        return self._output.getfloat('PostRoll', 30)
+
+    def fan_out(self):
+        return self._output.get('FanOut', 'pipe')
+
+    def forwarding(self):
+        return self._output.get('Forwarding', 'copy')
+
+    def pipe_size(self):
+        return self._output.getint('PipeSize', 2**20)
+
+    def queue_size(self):
+        return self._output.getint('QueueSize', 16 * 2**20)
+
+    def overflow_policy(self):
+        return self._output.get('OverflowPolicy', 'block')
+
 
 class CameraMotionConfig:
-    def __init__(self, config):
+    def __init__(self, config, zones=None):
         self._motion = config
+        self._zones = zones or []
+
+    def zones(self):
+        return self._zones
+
+    def algorithm(self):
+        return self._motion.get('Algorithm', 'basic')
 
     def resolution_scale(self):
         return self._motion.getfloat('ResolutionScale')
 
+    def decode(self):
+        return self._motion.get('Decode', 'all')
+
+    def max_rate(self):
+        return self._motion.getfloat('MaxRate', 1.0)
+
+    def min_rate(self):
+        return self._motion.getfloat('MinRate', self.max_rate())
+
+    def rate_decay(self):
+        return self._motion.getfloat('RateDecay', 10.0)
+
     def threshold(self):
         return self._motion.getfloat('Threshold')
 
@@ -134,8 +200,45 @@ class CameraMotionConfig:
     def cooldown(self):
         return self._motion.getint('Cooldown')
 
-    def logfile(self):
-        return self._motion.get('Log')
+    def prefilter(self):
+        return self._motion.getboolean('Prefilter', False)
+
+    def queue_size(self):
+        return self._motion.getint('QueueSize', 4 * 2**20)
+
+    def overflow_policy(self):
+        return self._motion.get('OverflowPolicy', 'drop-to-keyframe')
+
+    def events(self):
+        return self._motion.get('Events', '/var/lib/libreeye/events.db')
+
+    def event_gap(self):
+        return self._motion.getfloat('EventGap', 10)
+
+
+class MotionZoneConfig:
+    def __init__(self, name, config, motion):
+        self._name = name
+        self._zone = config
+        self._motion = motion
+
+    def name(self):
+        return self._name
+
+    def polygon(self):
+        # Points as x,y fractions of the frame width and height
+        return [
+            tuple(float(v) for v in point.split(','))
+            for point in self._zone.get('Polygon').split()
+        ]
+
+    def threshold(self):
+        return self._zone.getfloat(
+            'Threshold', self._motion.getfloat('Threshold'))
+
+    def min_area(self):
+        return self._zone.getfloat(
+            'MinArea', self._motion.getfloat('MinArea'))
 
 
 class StorageConfig:
@@ -162,6 +265,9 @@ class LocalStorageConfig:
     def segment_length(self):
         return self._local.getint('SegmentLength')
 
+    def segmenter(self):
+        return self._local.get('Segmenter', 'libreeye')
+
     def expiration(self):
         return self._local.getint('Expiration', 30)
 
@@ -0,0 +1,58 @@
+import shutil
+import subprocess
+import threading
+import time
+
+import pytest
+
+from libreeye.md.iterator import FrameIterator
+
+# The live pipe path needs a real ffmpeg, and is fed in real time
+pytestmark = pytest.mark.skipif(shutil.which('ffmpeg') is None,
+                                reason='ffmpeg is not installed')
+
+_width, _height, _framerate = 640, 480, 10
+# Seconds of the stream written at once, for ffmpeg to probe it, and then in
+# real time
+_probe_seconds, _live_seconds = 4, 6
+
+
+def _raw_stream(duration, gop):
+    # H.264 elementary stream of noise, so that probing takes whole seconds
+    return subprocess.run([
+        'ffmpeg', '-v', 'error', '-f', 'lavfi', '-i',
+        f'testsrc=size={_width}x{_height}:rate={_framerate}:'
+        f'duration={duration}',
+        '-vf', 'noise=alls=60:allf=t', '-c:v', 'libx264', '-b:v', '8M',
+        '-g', str(gop), '-keyint_min', str(gop), '-sc_threshold', '0',
+        '-f', 'h264', 'pipe:'
+    ], check=True, stdout=subprocess.PIPE).stdout
+
+
+def _feed(frame_iter, data, duration):
+    while frame_iter.pipe_fd() is None:
+        time.sleep(0.01)
+    chunk = len(data) // duration // _framerate
+    probe = chunk * _framerate * _probe_seconds
+    frame_iter.write(data[:probe])
+    for start in range(probe, len(data), chunk):
+        frame_iter.write(data[start:start + chunk])
+        frame_iter.pipe_fd()
+        time.sleep(1 / _framerate)
+    frame_iter.close()
+
+
+def test_live_keyframes_at_rate():
+    # A keyframe every second, analyzed at one frame per second: all of them
+    # but those of the stream probed at once are kept
+    duration = _probe_seconds + _live_seconds
+    data = _raw_stream(duration, _framerate)
+    frame_iter = FrameIterator('h264', _width, _height, _framerate, 0.5,
+                               keyframes_only=True, rate=1)
+    feeder = threading.Thread(target=_feed,
+                              args=(frame_iter, data, duration))
+    feeder.start()
+    frames = [frame.shape for frame in frame_iter]
+    feeder.join()
+    assert _live_seconds - 2 <= len(frames) <= _live_seconds + 2
+    assert frames[0] == (_height // 2, _width // 2)